@@ -2,18 +2,22 @@ import os
 import asyncio
 import logging
 import logging.handlers
+import multiprocessing.queues
+from typing import List
 from dotenv import load_dotenv
 import discord
 from discord.ext import commands
 
+load_dotenv()  # before importing modules configured by environment variables, e.g. MEDIA_WORKER_SOCKET
+
 from basic import Basic
 from music_player.music import Music
 from utils import send
 
 
-def setup_logging():
+def setup_logging(filename: str = 'discord.log'):
     handler = logging.handlers.RotatingFileHandler(
-        filename='discord.log',
+        filename=filename,
         encoding='utf-8',
         maxBytes=32 * 1024 * 1024,  # 32 MiB
         backupCount=5,  # Rotate through 5 files
@@ -27,18 +31,29 @@ def setup_logging():
     discord.utils.setup_logging(level=logging.WARNING, handler=handler, formatter=formatter, root=True)
 
 
-async def run_discord_bot():
+async def run_discord_bot(
+        shard_ids: List[int] | None = None,
+        shard_count: int | None = None,
+        stats_queue: multiprocessing.queues.Queue | None = None,
+):
+    """
+    Run the bot until it is closed. With shard_ids, this process connects only these shards out of shard_count
+    (see launcher.py) and reports its stats to stats_queue.
+    """
     intents = discord.Intents.default()
     intents.message_content = True
 
-    bot = commands.Bot(
+    bot_cls = commands.AutoShardedBot if shard_ids is not None else commands.Bot
+    sharding = {'shard_ids': shard_ids, 'shard_count': shard_count} if shard_ids is not None else {}
+    bot = bot_cls(
         command_prefix='!',
         intents=intents,
         status=discord.Status.online,
         activity=discord.Activity(
             type=discord.ActivityType.watching,
             name="!help or description"
-        )
+        ),
+        **sharding
     )
 
     @bot.event
@@ -50,6 +65,8 @@ async def run_discord_bot():
         for guild in bot.guilds:
             print(f"{guild.name} (ID: {guild.id})")
         print('------')
+        if shard_ids is not None and 0 not in shard_ids:
+            return  # commands are synced once, by the process with the first shard
         # myguild = bot.get_guild(1066347015509921852)
         # synced = await bot.tree.sync(guild=myguild)
         synced = await bot.tree.sync()
@@ -84,10 +101,30 @@ async def run_discord_bot():
     async with bot:
         await bot.add_cog(Basic(bot))
         await bot.add_cog(Music(bot))
+        if stats_queue is not None:
+            bot.loop.create_task(report_stats(bot, shard_ids, stats_queue))
         await bot.start(DISCORD_TOKEN)
 
     return bot
 
+
+async def report_stats(
+        bot: commands.Bot, shard_ids: List[int], stats_queue: multiprocessing.queues.Queue, interval: float = 30
+):
+    """ Periodically send stats of this process to the shard supervisor. """
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        stats = {
+            'pid': os.getpid(),
+            'shards': shard_ids,
+            'guilds': len(bot.guilds),
+            'latency': round(bot.latency, 3),
+            **bot.cogs['Music'].stats,
+        }
+        await bot.loop.run_in_executor(None, stats_queue.put, stats)
+        await asyncio.sleep(interval)
+
+
 if __name__ == "__main__":
     setup_logging()
     asyncio.run(run_discord_bot())
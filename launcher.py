@@ -0,0 +1,158 @@
+"""
+Sharded launcher: runs the bot as several processes, each connected to its own subset of Discord shards, with its
+own players, voice encoding and extraction workers. A supervisor restarts crashed processes and aggregates their
+stats into SHARD_STATS_FILE, which /status shows.
+
+Environment variables (besides the ones of app.py):
+    SHARD_PROCESSES: number of bot processes (default: number of CPU cores)
+    SHARD_COUNT: total number of Discord shards, at least SHARD_PROCESSES (default: SHARD_PROCESSES)
+"""
+import os
+import json
+import time
+import queue
+import signal
+import asyncio
+import logging
+import multiprocessing.queues
+from typing import Dict, List
+from dotenv import load_dotenv
+
+from app import setup_logging, run_discord_bot
+from utils import SHARD_STATS_FILE
+
+
+def run_shard(index: int, shard_ids: List[int], shard_count: int, stats_queue: multiprocessing.queues.Queue):
+    """ Entry point of a bot process. """
+    setup_logging(f'discord.{index}.log')
+    asyncio.run(run_discord_bot(shard_ids, shard_count, stats_queue))
+
+
+class ShardSupervisor:
+    """
+    Starts one process per group of shards and restarts it when it exits. Processes which crash shortly after
+    their start are restarted with exponential backoff, so a persistent failure doesn't restart in a loop.
+    """
+
+    def __init__(
+            self,
+            processes: int,
+            shard_count: int,
+            restart_delay: float = 5,
+            max_restart_delay: float = 300,
+            stable_after: float = 600,
+    ):
+        self.shard_count = max(shard_count, processes)
+        self.shard_groups = [list(range(i, self.shard_count, processes)) for i in range(processes)]
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after  # seconds of uptime after which the backoff is reset
+
+        self._context = multiprocessing.get_context('spawn')  # don't fork the event loop or worker threads
+        self.stats_queue = self._context.Queue()
+        self.processes: List[multiprocessing.Process | None] = [None] * processes
+        self.started = [0.] * processes
+        self.delays = [restart_delay] * processes
+        self.restart_at = [0.] * processes
+        self.restarts = [0] * processes
+        self.stats: Dict[int, Dict] = {}  # index -> last reported stats
+        self.stopping = False
+
+    def start(self, index: int):
+        process = self._context.Process(
+            target=run_shard, name=f'shard-{index}',
+            args=(index, self.shard_groups[index], self.shard_count, self.stats_queue)
+        )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.time()
+        logging.warning(f'Started process {process.pid} for shards {self.shard_groups[index]}')
+
+    def check(self, index: int):
+        """ Schedule restart of an exited process, and restart it once its delay passed. """
+        process = self.processes[index]
+        now = time.time()
+        if process is not None and not process.is_alive():
+            logging.warning(f'Process for shards {self.shard_groups[index]} exited with code {process.exitcode}')
+            if now - self.started[index] > self.stable_after:
+                self.delays[index] = self.restart_delay
+            self.restart_at[index] = now + self.delays[index]
+            self.delays[index] = min(self.delays[index] * 2, self.max_restart_delay)
+            self.processes[index] = None
+            self.stats.pop(index, None)
+        if self.processes[index] is None and now >= self.restart_at[index] and not self.stopping:
+            if self.restart_at[index]:
+                self.restarts[index] += 1
+            self.start(index)
+
+    def collect_stats(self, timeout: float):
+        try:
+            stats = self.stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        for index, shard_ids in enumerate(self.shard_groups):
+            if stats.get('shards') == shard_ids:
+                self.stats[index] = {**stats, 'restarts': self.restarts[index], 'reported': time.time()}
+
+    @property
+    def aggregated(self) -> Dict:
+        per_process = list(self.stats.values())
+        totals = {
+            key: sum(stats.get(key, 0) for stats in per_process)
+            for key in ('guilds', 'players', 'playing', 'queued', 'extractor_queue')
+        }
+        return {
+            'processes': len(self.processes),
+            'alive': sum(1 for process in self.processes if process is not None and process.is_alive()),
+            'shard_count': self.shard_count,
+            'restarts': sum(self.restarts),
+            **totals,
+            'per_process': per_process,
+        }
+
+    def write_stats(self):
+        os.makedirs(os.path.dirname(SHARD_STATS_FILE), exist_ok=True)
+        tmp_filename = SHARD_STATS_FILE + '.part'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.aggregated, f)
+        os.replace(tmp_filename, SHARD_STATS_FILE)
+
+    def run(self, stats_interval: float = 30):
+        for index in range(len(self.processes)):
+            self.start(index)
+        last_written = 0.
+        while not self.stopping:
+            self.collect_stats(timeout=1)
+            for index in range(len(self.processes)):
+                self.check(index)
+            if time.time() - last_written > stats_interval:
+                self.write_stats()
+                last_written = time.time()
+        self.shutdown()
+
+    def stop(self, *_args):
+        self.stopping = True
+
+    def shutdown(self, timeout: float = 10):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    process.kill()
+        try:
+            os.remove(SHARD_STATS_FILE)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    setup_logging()
+    processes = int(os.getenv('SHARD_PROCESSES', os.cpu_count() or 1))
+    supervisor = ShardSupervisor(processes, int(os.getenv('SHARD_COUNT', processes)))
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    supervisor.run()
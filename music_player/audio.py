@@ -0,0 +1,288 @@
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import numpy as np
+import discord
+
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE  # bytes of 20ms of 16-bit 48kHz stereo PCM
+FRAME_VALUES = FRAME_SIZE // 2  # int16 values per frame (samples * channels)
+CHANNELS = discord.opus.Encoder.CHANNELS
+FRAMES_PER_SECOND = 1000 // discord.opus.Encoder.FRAME_LENGTH
+
+
+class PCMProcessor(discord.AudioSource):
+    """
+    Replacement of discord.PCMVolumeTransformer, which processes 20ms PCM frames with NumPy.
+    Volume changes are ramped over a few frames instead of jumping, and a constant per-track gain can be set.
+    All buffers are allocated once, so reading a frame doesn't allocate arrays.
+    """
+
+    def __init__(self, original: discord.AudioSource, volume: float = 1., gain_db: float = 0., ramp_frames: int = 10):
+        if original.is_opus():
+            raise discord.ClientException('AudioSource must not be Opus encoded.')
+
+        self.original = original
+        self.gain = 10 ** (gain_db / 20)
+        self.ramp_frames = ramp_frames  # number of frames to get from current volume to new volume
+
+        self._volume = volume  # target volume
+        self._current = volume * self.gain  # factor applied to the last frame
+        self._ramp_target = self._current  # factor the running ramp leads to
+        self._ramp_left = 0  # frames until the ramp reaches its target
+        self._step = 0.  # change of the factor per frame during the ramp
+
+        # 0..1 linear ramp over one frame, same value for all channels of a sample
+        self._ramp = np.repeat(np.linspace(0, 1, FRAME_VALUES // CHANNELS, endpoint=False, dtype=np.float32), CHANNELS)
+        self._factors = np.empty(FRAME_VALUES, dtype=np.float32)
+        self._buffer = np.empty(FRAME_VALUES, dtype=np.float32)
+        self._out = np.empty(FRAME_VALUES, dtype=np.int16)
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = max(value, 0.)
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if len(data) != FRAME_SIZE:
+            return data
+        return self.process(data)
+
+    def process(self, data: bytes) -> bytes:
+        target = self._volume * self.gain
+        current = self._current
+        if current == target == 1:
+            return data
+
+        frame = np.frombuffer(data, dtype=np.int16)
+        if current == target:
+            np.multiply(frame, np.float32(target), out=self._buffer)
+        else:
+            # move linearly towards target, reaching it exactly after self.ramp_frames frames
+            if target != self._ramp_target:
+                self._ramp_target = target
+                self._ramp_left = max(self.ramp_frames, 1)
+                self._step = (target - current) / self._ramp_left
+            self._ramp_left -= 1
+            end = target if self._ramp_left <= 0 else current + self._step
+            np.multiply(self._ramp, np.float32(end - current), out=self._factors)
+            self._factors += np.float32(current)
+            np.multiply(frame, self._factors, out=self._buffer)
+            self._current = end
+
+        np.clip(self._buffer, -32768, 32767, out=self._buffer)
+        np.copyto(self._out, self._buffer, casting='unsafe')
+        return self._out.tobytes()
+
+
+class TrackMixer(discord.AudioSource):
+    """
+    AudioSource which plays tracks one after another without stopping the voice client, so there is no gap
+    between them. The next track is handed over with set_next() while the current one still plays, which also
+    starts its decoder early. PCM tracks can be crossfaded.
+
+    Callbacks are called from the audio thread with the token passed to set_next():
+        on_track_start(token): track started playing
+        on_track_end(token): track finished or was skipped
+        on_need_next(token): track is about to end (or its duration is unknown), next one should be set
+    """
+
+    def __init__(
+            self,
+            on_track_start: Callable[[Any], None],
+            on_track_end: Callable[[Any], None],
+            on_need_next: Callable[[Any], None],
+            crossfade: float = 0.,
+            warmup: float = 10.,
+    ):
+        self.on_track_start = on_track_start
+        self.on_track_end = on_track_end
+        self.on_need_next = on_need_next
+        self.crossfade_frames = int(crossfade * FRAMES_PER_SECOND)
+        self.warmup_frames = int(warmup * FRAMES_PER_SECOND)  # request next track that many frames before the end
+
+        self._opus: bool | None = None  # decided by the first track
+        self._lock = threading.Lock()
+        self._current: MixerTrack | None = None  # only used by audio thread
+        self._pending: MixerTrack | None = None
+        self._closed = False
+        self._skip = False
+
+        self._ramp = np.repeat(np.linspace(0, 1, FRAME_VALUES // CHANNELS, endpoint=False, dtype=np.float32), CHANNELS)
+        self._factors = np.empty(FRAME_VALUES, dtype=np.float32)
+        self._buffer = np.empty(FRAME_VALUES, dtype=np.float32)
+        self._mixed = np.empty(FRAME_VALUES, dtype=np.float32)
+        self._out = np.empty(FRAME_VALUES, dtype=np.int16)
+
+    def set_next(self, source: discord.AudioSource, token: Any, duration: float | None = None) -> bool:
+        """ Queue source to be played after the current one. Returns False if it can't be played gaplessly. """
+        with self._lock:
+            if self._closed or self._pending is not None:
+                return False
+            if self._opus is not None and self._opus != source.is_opus():
+                return False
+            self._opus = source.is_opus()
+            total_frames = int(duration * FRAMES_PER_SECOND) if duration else None
+            self._pending = MixerTrack(source, token, total_frames)
+            return True
+
+    @property
+    def remaining(self) -> float | None:
+        """ Seconds until the current track ends, None if nothing plays or its duration is unknown. """
+        current = self._current
+        if current is None or current.total_frames is None:
+            return None
+        return max(current.total_frames - current.frames, 0) / FRAMES_PER_SECOND
+
+    @property
+    def pending_token(self) -> Any:
+        pending = self._pending
+        return pending.token if pending is not None else None
+
+    def take_pending(self) -> Any:
+        """
+        Take back the track queued by set_next() before it becomes audible. Returns its token, or None if there
+        is no such track. The caller cleans up its source.
+        """
+        with self._lock:
+            pending = self._pending
+            if pending is None or pending.frames > 0:  # already fading in
+                return None
+            self._pending = None
+        return pending.token
+
+    def skip(self):
+        """ End the current track at the next frame. """
+        self._skip = True
+
+    @property
+    def volume(self) -> float | None:
+        current = self._current
+        return getattr(current.source, 'volume', None) if current else None
+
+    @volume.setter
+    def volume(self, value: float):
+        for track in (self._current, self._pending):
+            if track is not None and hasattr(track.source, 'volume'):
+                track.source.volume = value
+
+    def is_opus(self) -> bool:
+        return bool(self._opus)
+
+    def read(self) -> bytes:
+        if self._skip:
+            self._skip = False
+            self._end_current()
+
+        current = self._current
+        if current is None:
+            current = self._start_pending()
+            if current is None:
+                return b''
+
+        if not current.need_next_sent and (
+                current.total_frames is None or current.frames >= current.total_frames - self.warmup_frames
+        ):
+            current.need_next_sent = True
+            self.on_need_next(current.token)
+
+        if self._crossfading(current):
+            return self._read_crossfade(current)
+
+        data = current.source.read()
+        if not data:
+            self._end_current()
+            current = self._start_pending()
+            if current is None:
+                return b''
+            data = current.source.read()
+        current.frames += 1
+        return data
+
+    def _crossfading(self, current: 'MixerTrack') -> bool:
+        return (
+            not self._opus and self.crossfade_frames > 0 and self._pending is not None
+            and current.total_frames is not None
+            and current.frames >= current.total_frames - self.crossfade_frames
+        )
+
+    def _read_crossfade(self, current: 'MixerTrack') -> bytes:
+        pending = self._pending
+        if pending is None:  # taken back by take_pending() meanwhile
+            data = current.source.read()
+            current.frames += 1
+            return data
+        fade_start = current.total_frames - self.crossfade_frames
+        position = (current.frames - fade_start) / self.crossfade_frames
+        end = min(position + 1 / self.crossfade_frames, 1.)
+
+        data = current.source.read()
+        next_data = pending.source.read()
+        current.frames += 1
+        pending.frames += 1
+        if len(next_data) != FRAME_SIZE:
+            return data if len(data) == FRAME_SIZE else b''  # next track is broken, keep playing the current one
+        if len(data) != FRAME_SIZE:
+            # current track ended earlier than expected
+            self._end_current()
+            self._start_pending()
+            return next_data
+
+        # linear fade over the frame: current goes from 1 - position to 1 - end, next from position to end
+        np.multiply(self._ramp, np.float32(end - position), out=self._factors)
+        self._factors += np.float32(position)
+        np.multiply(np.frombuffer(next_data, dtype=np.int16), self._factors, out=self._mixed)
+        np.subtract(1, self._factors, out=self._factors)
+        np.multiply(np.frombuffer(data, dtype=np.int16), self._factors, out=self._buffer)
+        self._mixed += self._buffer
+        np.clip(self._mixed, -32768, 32767, out=self._mixed)
+        np.copyto(self._out, self._mixed, casting='unsafe')
+
+        if end >= 1:
+            # fade is over, current track is not audible anymore
+            self._end_current()
+            self._start_pending()
+        return self._out.tobytes()
+
+    def _start_pending(self) -> Optional['MixerTrack']:
+        with self._lock:
+            track, self._pending = self._pending, None
+            self._current = track
+            if track is None:
+                self._closed = True
+                return None
+        self.on_track_start(track.token)
+        return track
+
+    def _end_current(self):
+        track, self._current = self._current, None
+        if track is not None:
+            self.on_track_end(track.token)
+
+    def cleanup(self):
+        with self._lock:
+            self._closed = True
+            tracks = [self._current, self._pending]
+            self._current = self._pending = None
+        for track in tracks:
+            if track is not None:
+                self.on_track_end(track.token)
+
+
+@dataclass
+class MixerTrack:
+    source: discord.AudioSource
+    token: Any
+    total_frames: int | None  # expected length of the track
+    frames: int = 0  # frames read so far
+    need_next_sent: bool = False
@@ -0,0 +1,161 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict, List
+
+
+@dataclass
+class StoredAudio:
+    size: int  # bytes on disk of all files of this entry
+    accessed: float  # last time the audio was requested
+    refcount: int = 0  # number of queued or playing tracks using this audio
+
+
+class AudioStore:
+    """
+    Shared storage of downloaded audio files, used by all guilds.
+    Files are content addressed by yt_dlp output template '<extractor>-<id>.<ext>'. Entries which are not
+    used by any queued or playing track stay on disk until the byte budget is exceeded, then the least
+    recently used ones are deleted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, grace_period: float = 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.grace_period = grace_period  # don't evict entries accessed less than that many seconds ago
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted_bytes = 0
+
+        self._lock = threading.Lock()
+        self._entries: Dict[str, StoredAudio] = {}
+        self._eviction_task: asyncio.Future | None = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def key(filename: str) -> str:
+        # restrictfilenames guarantees there are no other dots in '<extractor>-<id>'
+        return os.path.basename(filename).split('.')[0]
+
+    def _scan(self):
+        """ Pick up files left from previous runs. """
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith('.part') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entry = self._entries.setdefault(self.key(filename), StoredAudio(size=0, accessed=stat.st_mtime))
+            entry.size += stat.st_size
+            entry.accessed = max(entry.accessed, stat.st_mtime)
+
+    def _files(self, key: str) -> List[str]:
+        return [
+            os.path.join(self.directory, filename) for filename in os.listdir(self.directory)
+            if self.key(filename) == key and not filename.endswith('.part')
+        ]
+
+    def __contains__(self, filename: str) -> bool:
+        return self.key(filename) in self._entries and os.path.isfile(filename)
+
+    def acquire(self, filename: str):
+        """ Register downloaded file and mark it as used until self.release(). """
+        key = self.key(filename)
+        size = sum(os.path.getsize(path) for path in self._files(key))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                entry = self._entries[key] = StoredAudio(size=size, accessed=time.time())
+            else:
+                self.hits += 1
+                entry.size = size
+                entry.accessed = time.time()
+            entry.refcount += 1
+        try:
+            os.utime(filename)  # keep LRU order over restarts
+        except OSError:
+            pass
+
+    def refresh(self, filename: str):
+        """ Recalculate size of an entry after a file was added to it, e.g. Opus frames next to the audio. """
+        key = self.key(filename)
+        size = sum(os.path.getsize(path) for path in self._files(key))
+        with self._lock:
+            entry = self._entries.setdefault(key, StoredAudio(size=0, accessed=time.time()))
+            entry.size = size
+
+    def release(self, filename: str):
+        with self._lock:
+            entry = self._entries.get(self.key(filename))
+            if entry is not None:
+                entry.refcount = max(entry.refcount - 1, 0)
+                entry.accessed = time.time()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+    def schedule_eviction(self, loop: asyncio.AbstractEventLoop):
+        """ Delete least recently used unreferenced files in executor, if store is over budget. """
+        if self.total_bytes <= self.max_bytes:
+            return
+        if self._eviction_task is None or self._eviction_task.done():
+            self._eviction_task = loop.run_in_executor(None, self._evict)
+
+    def _evict(self):
+        now = time.time()
+        with self._lock:
+            excess = sum(entry.size for entry in self._entries.values()) - self.max_bytes
+            candidates = sorted(
+                (item for item in self._entries.items()
+                 if item[1].refcount == 0 and now - item[1].accessed > self.grace_period),
+                key=lambda item: item[1].accessed
+            )
+            victims = []
+            for key, entry in candidates:
+                if excess <= 0:
+                    break
+                victims.append((key, entry))
+                excess -= entry.size
+
+        for key, entry in victims:
+            files = self._files(key)
+            with self._lock:
+                if self._recently_used(files, now):
+                    # acquired by another bot process (see launcher.py) sharing the directory, keep counting it
+                    entry.accessed = now
+                    continue
+                if self._entries.get(key) is not entry or entry.refcount > 0:
+                    continue  # acquired again meanwhile
+                del self._entries[key]
+            for path in files:
+                try:
+                    self.evicted_bytes += os.path.getsize(path)
+                    os.remove(path)
+                except OSError as e:
+                    logging.warning(f'Failed to evict {path} from audio store: {e}')
+
+    def _recently_used(self, files: List[str], now: float) -> bool:
+        try:
+            return any(now - os.path.getmtime(path) < self.grace_period for path in files)
+        except OSError:
+            return True  # deleted or replaced meanwhile, leave it to its owner
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'in_use': sum(1 for entry in self._entries.values() if entry.refcount > 0),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted_bytes': self.evicted_bytes,
+            }
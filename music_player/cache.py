@@ -0,0 +1,120 @@
+import os
+import time
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+
+class TTLCache:
+    """
+    Persistent key-value cache in SQLite with per-entry expiration time and LRU eviction.
+    Optionally, the most recently used entries are also kept in memory. Hits are counted per entry.
+    Values must be JSON serializable. Safe to use from multiple threads.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int = 10000, memory_entries: int = 0):
+        self.path = path
+        self.ttl = ttl  # default time to live of an entry in seconds
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory: OrderedDict[str, Tuple[float, Any]] = OrderedDict()  # key -> (expires, value)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')  # no fsync per write, lookups are done on the event loop
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL, '
+            'hits INTEGER NOT NULL DEFAULT 0)'
+        )
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(cache)')]
+        if 'hits' not in columns:  # created by older version
+            self._db.execute('ALTER TABLE cache ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+
+    def get(self, key: str) -> Any | None:
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                expires, value = self._memory[key]
+                if expires >= now:
+                    self._memory.move_to_end(key)
+                    self._touch(key, now)
+                    return value
+                del self._memory[key]
+            row = self._db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None
+            self._touch(key, now)
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+        return value
+
+    def _touch(self, key: str, now: float):
+        # memory hits are written too, so that LRU order and hit counts of hot entries stay correct
+        self._db.execute('UPDATE cache SET accessed = ?, hits = hits + 1 WHERE key = ?', (now, key))
+        self.hits += 1
+
+    def _remember(self, key: str, expires: float, value: Any):
+        if self.memory_entries <= 0:
+            return
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def set(self, key: str, value: Any, ttl: float | None = None):
+        now = time.time()
+        expires = now + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires, now)
+            )
+            self._remember(key, expires, value)
+            self._evict(now)
+
+    def top(self, n: int = 5) -> List[Tuple[str, int]]:
+        """ Keys of the n most hit entries with their hit counts. """
+        with self._lock:
+            return self._db.execute(
+                'SELECT key, hits FROM cache WHERE hits > 0 ORDER BY hits DESC LIMIT ?', (n,)
+            ).fetchall()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def _evict(self, now: float):
+        # drop expired entries first, then least recently used ones
+        self.evictions += self._db.execute('DELETE FROM cache WHERE expires < ?', (now,)).rowcount
+        count = self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if count > self.max_entries:
+            self.evictions += self._db.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (count - self.max_entries,)
+            ).rowcount
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -1,22 +1,123 @@
 from datetime import timedelta
-from typing import Optional, List
+from typing import Dict, List, Optional
 import discord
 
 from music_player.track import Track
-from utils import send, edit
+from music_player.track_queue import TrackQueue
+from utils import send, edit, edit_scheduler
+
+FIELD_LIMIT = 1024  # characters of embed field value accepted by Discord
+
+
+def shorten(text: str, width: int) -> str:
+    """ Cut text to at most width characters, marking the cut with an ellipsis. """
+    return text if len(text) <= width else text[:max(width - 1, 0)] + '…'
+
+
+class QueueView(discord.ui.View):
+    """ Buttons of the player embed to browse pages of the queue. """
+
+    def __init__(self, player_embed: 'PlayerEmbed'):
+        super().__init__(timeout=None)
+        self.player_embed = player_embed
+
+    def update_buttons(self, page: int, pages: int) -> bool:
+        """ Enable buttons which lead to another page. Returns True if any button changed. """
+        states = (page <= 0, page <= 0, page >= pages - 1, page >= pages - 1)
+        buttons = (self.first, self.previous, self.next, self.last)
+        changed = any(button.disabled != state for button, state in zip(buttons, states))
+        for button, state in zip(buttons, states):
+            button.disabled = state
+        return changed
+
+    @discord.ui.button(emoji='⏮', style=discord.ButtonStyle.secondary)
+    async def first(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.player_embed.show_page(interaction, 0)
+
+    @discord.ui.button(emoji='◀', style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.player_embed.show_page(interaction, self.player_embed.page - 1)
+
+    @discord.ui.button(emoji='▶', style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.player_embed.show_page(interaction, self.player_embed.page + 1)
+
+    @discord.ui.button(emoji='⏭', style=discord.ButtonStyle.secondary)
+    async def last(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.player_embed.show_page(interaction, self.player_embed.pages - 1)
 
 
 class PlayerEmbed:
-    def __init__(self):
+    """
+    Player status message: current song and one page of the queue, browsed with QueueView buttons.
+    Only the visible page is rendered, from a slice of the queue. Rendered pages are cached until the queue
+    changes, and the message is not edited if the embed would stay the same.
+    """
+
+    def __init__(self, page_size: int = 10):
         self.embed: discord.Embed | None = None  # discord.Embed about current player status
         self.msg: discord.Message | None = None  # object of message with self.embed
+        self.view: QueueView | None = None  # buttons of self.msg
+        self.page = 0  # shown page of the queue
+        self.page_size = page_size
+
+        # arguments of the last update(), to render other pages on button press
+        self.current: Track | None = None
+        self.queue: TrackQueue | None = None
+        self.channel: discord.VoiceChannel | None = None
+        self.pending: Track | None = None  # next song, already handed to the mixer, shown before the queue
+
+        self._pages: Dict[int, str] = {}  # page number -> rendered tracks, valid for self._pages_version
+        self._pages_version: tuple | None = None
+        self._sent: Dict | None = None  # self.embed as last sent to self.msg
+
+    @property
+    def queued(self) -> int:
+        return (len(self.queue) if self.queue is not None else 0) + (self.pending is not None)
+
+    @property
+    def pages(self) -> int:
+        return max((self.queued + self.page_size - 1) // self.page_size, 1)
+
+    def upcoming(self, start: int, stop: int) -> List[Track]:
+        """ Slice of the pending song followed by the queue. """
+        if self.pending is None:
+            return self.queue[start:stop]
+        tracks = [self.pending] if start == 0 else []
+        return tracks + self.queue[max(start - 1, 0):stop - 1]
 
     async def update(
             self,
             current: Optional[Track] = None,
-            queue: List[Track] = None,
-            channel: discord.VoiceChannel = None
+            queue: TrackQueue = None,
+            channel: discord.VoiceChannel = None,
+            pending: Optional[Track] = None,
     ):
+        self.current, self.queue, self.channel, self.pending = current, queue, channel, pending
+        self.render()
+
+        # edit existing message
+        if self.msg:
+            buttons_changed = self.view is not None and self.view.update_buttons(self.page, self.pages)
+            embed = self.embed.to_dict()
+            if embed == self._sent and not buttons_changed:
+                return
+            self._sent = embed
+            kwargs = {'view': self.view} if buttons_changed else {}
+            self.msg = await edit(self.msg, wait=False, embed=self.embed, **kwargs)
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        """ Answer button press by editing the message to show another page. """
+        self.page = page
+        self.render()
+        self.view.update_buttons(self.page, self.pages)
+        self._sent = self.embed.to_dict()
+        await interaction.response.edit_message(embed=self.embed, view=self.view)
+        edit_scheduler.discard(self.msg)  # pending edit would show the previous page
+
+    def render(self):
+        current, queue, channel = self.current, self.queue, self.channel
+
         # Now playing
         if current:
             current_str = self.track_to_str(current)
@@ -36,47 +137,74 @@ class PlayerEmbed:
             )
 
         # Queue
-        if len(queue) > 0:
-            songs_queue = queue if len(queue) <= 5 else queue[:5]
-            field_value = '\n'.join(f'{num}. {self.track_to_str(track)}' for num, track in enumerate(songs_queue))
-            if len(queue) > 5:
-                field_value += f'\nAnd {len(queue) - 5} more...'
+        self.page = min(max(self.page, 0), self.pages - 1)
+        if queue is not None and self.queued > 0:
+            # lines are shortened to fit the page in a field, Discord would reject the whole edit otherwise
             embed.add_field(
-                name=f'Queued songs: {len(queue)}',
-                value=field_value,
+                name=f'Queued songs: {self.queued}',
+                value=shorten(self.render_page(queue, self.page), FIELD_LIMIT),
                 inline=False
             )
 
             # footer: remaining time
-            queue_time = sum([source.duration for source in queue if source.duration])
+            pending = self.pending
+            queue_time = queue.queue_time + ((pending.duration or 0) if pending is not None else 0)
+            unknown_duration = queue.unknown_duration + (pending is not None and not pending.duration)
             footer_text = "Estimated queue time: " + str(timedelta(seconds=queue_time))
-            unknown_duration = len([source for source in queue if not source.duration])
             if unknown_duration > 0:
                 footer_text += " + " + str(unknown_duration) + " x unknown"
+            if self.pages > 1:
+                footer_text += f" | Page {self.page + 1}/{self.pages}"
             embed.set_footer(text=footer_text)
 
         # update self
         self.embed = embed
 
-        # edit existing message
-        if self.msg:
-            await edit(self.msg, embed=self.embed)
+    def render_page(self, queue: TrackQueue, page: int) -> str:
+        version = (id(queue), queue.version, id(self.pending))
+        if version != self._pages_version:
+            self._pages.clear()
+            self._pages_version = version
+        if page not in self._pages:
+            start = page * self.page_size
+            tracks = self.upcoming(start, start + self.page_size)
+            line_width = FIELD_LIMIT // self.page_size - 1  # newline
+            lines = []
+            for num, track in enumerate(tracks, start=start):
+                prefix = f'{num}. '
+                lines.append(prefix + self.track_to_str(track, line_width - len(prefix)))
+            self._pages[page] = '\n'.join(lines)
+        return self._pages[page]
 
     async def resend_msg(self, ctx):
         """ Resend self.embed as a new message in text channel. """
         if self.msg:
             await self.msg.delete()
-        self.msg = await send(ctx, embed=self.embed)
+        if self.view is not None:
+            self.view.stop()
+        self.view = QueueView(self)
+        self.view.update_buttons(self.page, self.pages)
+        self.msg = await send(ctx, embed=self.embed, view=self.view)
+        self._sent = self.embed.to_dict()
 
     @staticmethod
-    def track_to_str(track: Track):
-        if track.artist is not None:
-            song_str = f'`{track.title}` by `{track.artist}`'
-        else:
-            song_str = f'`{track.title}`'
-
-        requester_str = f'requested by `{track.requester.display_name}`'
+    def track_to_str(track: Track, width: Optional[int] = None):
+        """ Describe track, with title and artist shortened so that it fits in width characters if given. """
+        requester_str = f'requested by `{track.requester_name}`'
 
         duration_str = f'({timedelta(seconds=track.duration)})' if track.duration else '(unknown)'
 
+        title, artist = track.title, track.artist
+        if width is not None:
+            space = width - len(requester_str) - len(duration_str) - 4 - (6 if artist is not None else 0)
+            if artist is not None:
+                artist = shorten(artist, max(space // 3, 1))
+                space -= len(artist)
+            title = shorten(title, max(space, 1))
+
+        if artist is not None:
+            song_str = f'`{title}` by `{artist}`'
+        else:
+            song_str = f'`{title}`'
+
         return ' '.join([song_str, requester_str, duration_str])
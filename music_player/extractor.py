@@ -0,0 +1,174 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice
+from functools import partial
+from typing import AsyncIterator, Callable, Dict, Iterator, List
+from yt_dlp import YoutubeDL
+
+from music_player import opus_frames
+
+
+ytdlopts = {
+    'format': 'bestaudio/best',
+    'outtmpl': 'cache/ytdl/%(extractor)s-%(id)s.%(ext)s',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0'  # ipv6 addresses cause issues sometimes
+}
+
+_ytdlopts: Dict = {}  # options of worker YoutubeDL instances
+_local = threading.local()
+
+
+def _init_worker(ytdlopts: Dict):
+    global _ytdlopts
+    _ytdlopts = ytdlopts
+
+
+def worker_ytdl() -> YoutubeDL:
+    """ YoutubeDL instance owned by the current worker thread (or process). Never shared between workers. """
+    if not hasattr(_local, 'ytdl'):
+        _local.ytdl = YoutubeDL(_ytdlopts)
+    return _local.ytdl
+
+
+def extract_info(url: str, download: bool, process: bool) -> Dict:
+    ytdl = worker_ytdl()
+    data = ytdl.extract_info(url, download=download, process=process)
+    if process and 'entries' in data:
+        data = data['entries'][0]  # text search gives playlist with one entry out
+    elif not process and 'entries' in data:
+        data['entries'] = list(data['entries'])  # materialize lazy playlist entries
+    return ytdl.sanitize_info(data)
+
+
+def download_from_info(data: Dict) -> Dict:
+    """ Download audio with already extracted info, skipping metadata requests. """
+    ytdl = worker_ytdl()
+    return ytdl.sanitize_info(ytdl.process_ie_result(data, download=True))
+
+
+def playlist_entries(url: str) -> Iterator[Dict]:
+    """ Lazy iterator over playlist entries, pages are requested while iterating. """
+    data = worker_ytdl().extract_info(url, download=False, process=False)
+    return iter(data['entries'])
+
+
+def next_page(entries: Iterator[Dict], size: int) -> List[Dict]:
+    ytdl = worker_ytdl()
+    return [ytdl.sanitize_info(entry) for entry in islice(entries, size)]
+
+
+def _timed(func: Callable, *args):
+    return time.time(), func(*args)
+
+
+class ExtractorPool:
+    """
+    Dedicated bounded executor for yt_dlp jobs, so extraction doesn't compete with other executor tasks.
+    Each worker owns its own YoutubeDL instance. With processes=True, CPU heavy extraction
+    (signature deciphering) is not limited by the GIL of the bot process.
+    """
+
+    def __init__(self, ytdlopts: Dict, max_workers: int = 4, processes: bool = False):
+        self.ytdlopts = ytdlopts
+        self.max_workers = max_workers
+        self.processes = processes
+        self._executor: Executor | None = None  # created on first use
+        self.playlist_readers = asyncio.Semaphore(max_workers)
+
+        self.pending = 0  # submitted jobs which did not finish yet
+        self.completed = 0
+        self.failed = 0
+        self.avg_wait = 0.  # exponential moving averages in seconds
+        self.avg_run = 0.
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            executor_cls = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+            self._executor = executor_cls(
+                max_workers=self.max_workers, initializer=_init_worker, initargs=(self.ytdlopts,)
+            )
+        return self._executor
+
+    async def run(self, func: Callable, *args):
+        """ Run module level function (picklable for process workers) in the pool. """
+        loop = asyncio.get_running_loop()
+        submitted = time.time()
+        self.pending += 1
+        started = None
+        try:
+            started, result = await loop.run_in_executor(self.executor, _timed, func, *args)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            finished = time.time()
+            self.pending -= 1
+            if started is not None:
+                self.avg_wait = .9 * self.avg_wait + .1 * (started - submitted)
+                self.avg_run = .9 * self.avg_run + .1 * (finished - started)
+        self.completed += 1
+        return result
+
+    async def iter_playlist(self, url: str, page_size: int) -> AsyncIterator[List[Dict]]:
+        """
+        Yield playlist entries page by page while yt_dlp reads the playlist.
+        The lazy entries iterator can't leave the thread which created it, so every playlist is read by its own
+        thread with its own YoutubeDL instance. At most self.max_workers playlists are read at the same time.
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(self.ytdlopts,))
+        try:
+            async with self.playlist_readers:
+                entries = await loop.run_in_executor(executor, playlist_entries, url)
+            while True:
+                async with self.playlist_readers:
+                    page = await loop.run_in_executor(executor, next_page, entries, page_size)
+                if not page:
+                    break
+                yield page
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def extract_info(self, url: str, download: bool = False, process: bool = True) -> Dict:
+        return await self.run(extract_info, url, download, process)
+
+    async def download_from_info(self, data: Dict) -> Dict:
+        return await self.run(download_from_info, data)
+
+    async def convert_frames(self, filename: str, volume: float, copy: bool) -> str:
+        """ Encode Opus frames file of downloaded audio. FFmpeg does the work, a default executor thread waits. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(opus_frames.convert, filename, volume, copy=copy))
+
+    @property
+    def queue_depth(self) -> int:
+        """ Number of jobs waiting for a free worker. """
+        return max(self.pending - self.max_workers, 0)
+
+    @property
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            'workers': self.max_workers,
+            'processes': self.processes,
+            'queue_depth': self.queue_depth,
+            'running': self.pending - self.queue_depth,
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_wait': round(self.avg_wait, 3),
+            'avg_run': round(self.avg_run, 3),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
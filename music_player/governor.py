@@ -0,0 +1,200 @@
+import time
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from itertools import count
+from typing import AsyncIterator, Dict, List
+
+
+class Priority(IntEnum):
+    PLAYBACK = 0  # needed by the song which is about to play
+    PREFETCH = 1  # look-ahead of upcoming songs
+    BULK = 2  # adding playlists, encoding frames and other background work
+
+
+@dataclass
+class Job:
+    """ Who needs a resource and how urgently. Raise priority of a waiting job with ResourceGovernor.promote(). """
+    guild_id: int | None = None
+    priority: Priority = Priority.PLAYBACK
+    deadline: float | None = None  # time.monotonic() by which the result is needed, earlier deadlines go first
+
+
+@dataclass(eq=False)
+class _Waiter:
+    job: Job
+    seq: int
+    since: float  # time.monotonic() when it started waiting
+    future: asyncio.Future = field(repr=False)
+
+
+class Slot:
+    """ One unit of a resource, held until release(). """
+
+    def __init__(self, resource: 'Resource', guild_id: int | None):
+        self.resource = resource
+        self.guild_id = guild_id
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.resource._release(self)
+
+
+class Resource:
+    """
+    Semaphore which decides whom to admit next when a slot is freed: higher priority first, then the earliest
+    deadline, then the guild holding the fewest slots, then the longest waiting job. While other guilds wait,
+    a guild gets at most its fair share (limit divided by the number of active guilds).
+
+    Lower priority jobs leave reserved slots free (e.g. BULK jobs never take the last 2 slots), so a song which
+    is about to play doesn't wait until running bulk jobs finish. Waiting jobs age: every aging seconds of waiting
+    count as one priority class higher for the ordering, so bulk work is delayed but never starved.
+    """
+
+    def __init__(self, name: str, limit: int, reserved: Dict[Priority, int] | None = None, aging: float = 30):
+        self.name = name
+        self.limit = limit
+        self.reserved = reserved or {}  # priority -> number of slots which jobs of this priority leave free
+        self.aging = aging
+        self.in_use = 0
+        self.held: Counter[int | None] = Counter()  # guild id -> slots in use
+        self._waiters: List[_Waiter] = []
+        self._seq = count()
+
+        self.acquired = 0
+        self.late = 0  # jobs admitted after their deadline
+        self.avg_wait = 0.  # exponential moving average in seconds
+
+    async def acquire(self, job: Job) -> Slot:
+        waiter = _Waiter(job, next(self._seq), time.monotonic(), asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self.dispatch()
+        try:
+            slot = await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                waiter.future.result().release()  # granted just before the cancellation
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        self.avg_wait = .9 * self.avg_wait + .1 * (time.monotonic() - waiter.since)
+        return slot
+
+    def _admissible(self, job: Job) -> bool:
+        # with a limit lowered below the reservation every job may still use one slot, bulk work slows down but goes on
+        return self.in_use < max(self.limit - self.reserved.get(job.priority, 0), 1)
+
+    def set_limit(self, limit: int):
+        """ Change the number of slots. Slots in use above a lowered limit stay held until they are released. """
+        self.limit = limit
+        self.dispatch()
+
+    def dispatch(self):
+        """ Grant free slots to waiting jobs. """
+        while self._waiters:
+            candidates = [waiter for waiter in self._waiters if self._admissible(waiter.job)]
+            if not candidates:
+                return
+            waiter = self._next_waiter(candidates)
+            self._waiters.remove(waiter)
+            if not waiter.future.done():  # skip cancelled waiters
+                waiter.future.set_result(self._grant(waiter.job))
+
+    def _grant(self, job: Job) -> Slot:
+        self.in_use += 1
+        self.held[job.guild_id] += 1
+        self.acquired += 1
+        if job.deadline is not None and time.monotonic() > job.deadline:
+            self.late += 1
+        return Slot(self, job.guild_id)
+
+    def _release(self, slot: Slot):
+        self.in_use -= 1
+        self.held[slot.guild_id] -= 1
+        if self.held[slot.guild_id] <= 0:
+            del self.held[slot.guild_id]
+        self.dispatch()
+
+    def _next_waiter(self, candidates: List[_Waiter]) -> _Waiter:
+        active = {waiter.job.guild_id for waiter in self._waiters} | set(self.held)
+        quota = max(-(-self.limit // len(active)), 1)
+        under_quota = [waiter for waiter in candidates if self.held[waiter.job.guild_id] < quota]
+        now = time.monotonic()
+
+        def order(waiter: _Waiter):
+            aged_priority = waiter.job.priority - int((now - waiter.since) / self.aging)
+            deadline = waiter.job.deadline if waiter.job.deadline is not None else float('inf')
+            return aged_priority, deadline, self.held[waiter.job.guild_id], waiter.seq
+
+        return min(under_quota or candidates, key=order)
+
+    @property
+    def stats(self) -> Dict:
+        waiting = Counter(waiter.job.priority.name.lower() for waiter in self._waiters)
+        return {
+            'in_use': self.in_use,
+            'limit': self.limit,
+            'waiting': dict(waiting),
+            'guilds': len(self.held),
+            'acquired': self.acquired,
+            'late': self.late,
+            'avg_wait': round(self.avg_wait, 3),
+        }
+
+
+class ResourceGovernor:
+    """
+    Admission control for resources shared by all guilds, so that bulk work of a few guilds (e.g. large
+    playlist imports) can't exhaust CPU, bandwidth or file descriptors and degrade playback of the others.
+    """
+
+    def __init__(self, resources: List[Resource]):
+        self.resources = {resource.name: resource for resource in resources}
+
+    async def acquire(self, resource: str, job: Job | None = None) -> Slot:
+        """ Wait for a slot of the resource, to be released by the caller. """
+        return await self.resources[resource].acquire(job or Job())
+
+    @asynccontextmanager
+    async def slot(self, resource: str, job: Job | None = None) -> AsyncIterator[Slot]:
+        slot = await self.acquire(resource, job)
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def promote(self, job: Job, priority: Priority, deadline: float | None = None):
+        """ Raise priority of a job, which may already wait for a resource (e.g. prefetch of the next song). """
+        job.priority = min(job.priority, priority)
+        if deadline is not None:
+            job.deadline = deadline if job.deadline is None else min(job.deadline, deadline)
+        for resource in self.resources.values():
+            resource.dispatch()
+
+    @property
+    def stats(self) -> Dict[str, Dict]:
+        return {name: resource.stats for name, resource in self.resources.items()}
+
+    @property
+    def summary(self) -> str:
+        """ Short form of stats, one part per resource. """
+        return ', '.join(
+            f'{name} {resource.in_use}/{resource.limit} (waiting {len(resource._waiters)}, late {resource.late}, '
+            f'avg wait {resource.avg_wait:.2f} s)'
+            for name, resource in self.resources.items()
+        )
+
+
+# bulk and prefetch jobs leave slots free for songs which are about to play
+RESERVED = {Priority.PREFETCH: 1, Priority.BULK: 2}
+
+governor = ResourceGovernor([
+    Resource('extract', 8, RESERVED),  # yt_dlp metadata requests
+    Resource('download', 4, RESERVED),  # yt_dlp downloads
+    Resource('ffmpeg', 128),  # FFmpeg processes of playing and starting songs
+    Resource('encode', 2),  # background encoding of Opus frames files
+])
@@ -0,0 +1,231 @@
+"""
+Media worker daemon: runs yt_dlp resolve and download jobs and Opus frames encoding outside of the bot process,
+so that bursts of extraction don't delay Discord I/O and voice frames of the bot. Start it with
+    python -m music_player.media_worker
+and set MEDIA_WORKER_SOCKET for the bot to use it instead of in-process extraction.
+
+Protocol: JSON lines over a Unix socket. Requests {"id": 1, "op": "extract_info", "args": [...]} are answered
+with {"id": 1, "result": ...} or {"id": 1, "error": "..."}, in any order. Downloaded and encoded files are
+written to the cache directory shared with the bot, responses carry their info (and paths), not their content.
+
+Environment variables:
+    MEDIA_WORKER_SOCKET: path of the Unix socket (default: cache/media_worker.sock)
+    MEDIA_WORKERS: number of extraction workers (default: number of CPU cores)
+    MEDIA_WORKER_PROCESSES: run extraction workers as processes instead of threads, 1 or 0 (default: 0)
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from itertools import count
+from typing import AsyncIterator, Dict, List
+
+from music_player.extractor import ExtractorPool, ytdlopts
+
+
+MESSAGE_LIMIT = 64 * 1024 * 1024  # processed info with all formats is a few hundred KiB
+
+
+class MediaWorkerError(Exception):
+    """ Job failed in the media worker. """
+
+
+class MediaWorkerServer:
+    """ Serves jobs of any number of bot processes with one ExtractorPool. """
+
+    def __init__(self, pool: ExtractorPool):
+        self.pool = pool
+        self.connections = 0
+        self._handles = count(1)
+
+    async def serve(self, path: str):
+        if os.path.exists(path):
+            os.remove(path)  # left by previous run
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        server = await asyncio.start_unix_server(self._handle_connection, path, limit=MESSAGE_LIMIT)
+        logging.warning(f'Media worker listening on {path} with {self.pool.max_workers} workers')
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        playlists: Dict[int, AsyncIterator[List[Dict]]] = {}  # open playlists of this connection
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self._handle_request(json.loads(line), writer, playlists))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as e:
+            logging.warning(f'Media worker connection failed: {e}')
+        finally:
+            self.connections -= 1
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for playlist in playlists.values():
+                await playlist.aclose()
+            writer.close()
+
+    async def _handle_request(
+            self, request: Dict, writer: asyncio.StreamWriter, playlists: Dict[int, AsyncIterator[List[Dict]]]
+    ):
+        op, args = request['op'], request.get('args', [])
+        try:
+            if op == 'extract_info':
+                result = await self.pool.extract_info(*args)
+            elif op == 'download_from_info':
+                result = await self.pool.download_from_info(*args)
+            elif op == 'convert_frames':
+                result = await self.pool.convert_frames(*args)
+            elif op == 'playlist_open':
+                url, page_size = args
+                result = next(self._handles)
+                playlists[result] = self.pool.iter_playlist(url, page_size)
+            elif op == 'playlist_next':
+                result = await anext(playlists[args[0]], [])
+            elif op == 'playlist_close':
+                playlist = playlists.pop(args[0], None)
+                result = None
+                if playlist is not None:
+                    await playlist.aclose()
+            elif op == 'stats':
+                result = {**self.pool.stats, 'connections': self.connections}
+            else:
+                raise ValueError(f'Unknown operation {op}')
+            response = {'id': request.get('id'), 'result': result}
+        except Exception as e:
+            response = {'id': request.get('id'), 'error': f'{type(e).__name__}: {e}'}
+        if 'id' in request:  # requests without id are notifications
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+
+class MediaWorkerClient:
+    """
+    Drop-in replacement of ExtractorPool in the bot process, which sends the jobs to the media worker daemon.
+    One connection is shared by all concurrent jobs and reopened after the daemon restarts.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._connecting = asyncio.Lock()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = count(1)
+
+        self.completed = 0
+        self.failed = 0
+        self.avg_run = 0.  # exponential moving average of job round trip in seconds
+        self.remote_stats: Dict = {}  # last stats reported by the daemon
+
+    async def _connect(self):
+        async with self._connecting:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=MESSAGE_LIMIT)
+            loop = asyncio.get_running_loop()
+            loop.create_task(self._read_responses(self._reader))
+            loop.create_task(self._poll_stats(self._writer))
+
+    async def _poll_stats(self, writer: asyncio.StreamWriter, interval: float = 10):
+        """ Keep self.remote_stats up to date while the connection is open. """
+        while self._writer is writer:
+            try:
+                self.remote_stats = await self.request('stats')
+            except Exception as e:
+                logging.warning(f'Could not get media worker stats: {e}')
+            await asyncio.sleep(interval)
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                future = self._pending.pop(response['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in response:
+                    future.set_exception(MediaWorkerError(response['error']))
+                else:
+                    future.set_result(response['result'])
+        except (ConnectionError, ValueError) as e:
+            logging.warning(f'Media worker connection failed: {e}')
+        finally:
+            # daemon went away, fail the jobs sent over this connection
+            if self._reader is reader:
+                self._writer.close()
+                self._reader = self._writer = None
+                pending, self._pending = self._pending, {}
+                for future in pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError('Media worker connection closed'))
+
+    async def request(self, op: str, *args):
+        await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        started = time.time()
+        try:
+            self._writer.write(json.dumps({'id': request_id, 'op': op, 'args': args}).encode() + b'\n')
+            await self._writer.drain()
+            result = await future
+        except Exception:
+            self._pending.pop(request_id, None)
+            self.failed += 1
+            raise
+        self.completed += 1
+        self.avg_run = .9 * self.avg_run + .1 * (time.time() - started)
+        return result
+
+    async def extract_info(self, url: str, download: bool = False, process: bool = True) -> Dict:
+        return await self.request('extract_info', url, download, process)
+
+    async def download_from_info(self, data: Dict) -> Dict:
+        return await self.request('download_from_info', data)
+
+    async def convert_frames(self, filename: str, volume: float, copy: bool) -> str:
+        return await self.request('convert_frames', filename, volume, copy)
+
+    async def iter_playlist(self, url: str, page_size: int) -> AsyncIterator[List[Dict]]:
+        """ Yield playlist entries page by page, the playlist is read by the daemon. """
+        handle = await self.request('playlist_open', url, page_size)
+        try:
+            while page := await self.request('playlist_next', handle):
+                yield page
+        finally:
+            if self._writer is not None and not self._writer.is_closing():
+                # don't wait for the answer, the iterator may be closed because its task was cancelled
+                self._writer.write(json.dumps({'op': 'playlist_close', 'args': [handle]}).encode() + b'\n')
+
+    @property
+    def queue_depth(self) -> int:
+        return self.remote_stats.get('queue_depth', 0)
+
+    @property
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            'socket': self.path,
+            'connected': self._writer is not None and not self._writer.is_closing(),
+            'pending': len(self._pending),
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_run': round(self.avg_run, 3),
+            'worker': self.remote_stats,
+        }
+
+    def shutdown(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    pool = ExtractorPool(
+        ytdlopts,
+        max_workers=int(os.getenv('MEDIA_WORKERS', os.cpu_count() or 1)),
+        processes=os.getenv('MEDIA_WORKER_PROCESSES', '0') == '1',
+    )
+    asyncio.run(MediaWorkerServer(pool).serve(os.getenv('MEDIA_WORKER_SOCKET', 'cache/media_worker.sock')))
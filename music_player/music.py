@@ -1,6 +1,7 @@
 """
 Source: https://gist.github.com/EvieePy/ab667b74e9758433b3eb806c53a19f34
 """
+import time
 import asyncio
 import discord
 from discord.ext import commands
@@ -8,36 +9,55 @@ from typing import Literal, Optional, Dict, List
 
 from music_player.player import MusicPlayer
 from music_player.spotify_search import SpotifyHandler
-from music_player.track import Track
-from utils import response
+from music_player.audio import TrackMixer
+from music_player.governor import governor, Job, Priority
+from music_player.throttle import youtube_throttle
+from music_player.track import Track, metadata_cache, audio_store, extractor, youtube_index, extractions, \
+    search_index
+from utils import response, send, edit_scheduler, load_shard_stats, split_message
 
 
 class Music(commands.Cog):
     """Music related commands."""
 
-    __slots__ = ('bot', 'players')
+    __slots__ = ('bot', 'players', 'settings')
 
     def __init__(self, bot):
         self.bot = bot
         self.players: Dict[int, MusicPlayer] = {}
+        self.settings: Dict[int, Dict] = {}  # guild id -> player settings, kept when the player is destroyed
 
         self.spotify_handler = SpotifyHandler()
 
+    @property
+    def stats(self) -> Dict[str, int]:
+        """ Player stats of this process, reported to the shard supervisor. """
+        return {
+            'players': len(self.players),
+            'playing': sum(1 for player in self.players.values() if not player.stopped.is_set()),
+            'queued': sum(len(player.queue) for player in self.players.values()),
+            'extractor_queue': extractor.queue_depth,
+        }
+
     @staticmethod
     def get_voice_client(ctx: commands.Context) -> discord.VoiceClient | None:
         return ctx.voice_client
 
-    def get_player(self, ctx: commands.Context) -> MusicPlayer:
+    def get_player(self, ctx: commands.Context) -> MusicPlayer | None:
         """
-        Retrieve the guild player, or generate one.
+        Retrieve the guild player, or generate one if the bot is connected to voice.
         """
         guild_id = ctx.guild.id
         if guild_id in self.players:
-            player = self.players[guild_id]
-        else:
-            player = MusicPlayer(self.bot, self.get_voice_client(ctx))
-            self.players[guild_id] = player
-
+            return self.players[guild_id]
+        vc = self.get_voice_client(ctx)
+        if vc is None:
+            return None  # a player without voice client would drop all songs
+        player = MusicPlayer(self.bot, vc)
+        settings = self.settings.get(guild_id, {})
+        player.download = settings.get('download', player.download)
+        player.set_crossfade(settings.get('crossfade', player.crossfade))
+        self.players[guild_id] = player
         return player
 
     async def connect(self, ctx: commands.Context) -> Optional[str]:
@@ -68,38 +88,50 @@ class Music(commands.Cog):
                 msg = f'Connecting to channel: <{channel}> timed out.'
                 return msg
 
-    async def start_player(self, ctx: commands.Context) -> MusicPlayer:
+    async def start_player(self, ctx: commands.Context) -> MusicPlayer | None:
+        """ Connect to voice and return the player, or None if connecting failed (the user is told why). """
         msg = await self.connect(ctx)
         if msg:
             await response(ctx, msg)
 
         player = self.get_player(ctx)
-        await player.send_new_embed_msg(ctx)
+        if player is not None:
+            await player.send_new_embed_msg(ctx)
         return player
 
     @commands.hybrid_command(aliases=['p', 'yt', 'youtube'])
     async def play(
         self,
         ctx: commands.Context,
-        query: str
+        query: str,
+        stream: bool = None
     ):
         """
         Request a song by YouTube search or URL.
         Args:
             ctx: discord Context object
             query: Search query or YouTube URL (video or playlist)
+            stream: Stream songs instead of downloading them (default: server setting)
         """
+        requested_at = time.monotonic()
         player = await self.start_player(ctx)
+        if player is None:
+            return
 
         if "youtube.com" in query or "youtu.be" in query:
             if "playlist?list=" in query:
-                tracks = await Track.from_playlist(playlist_url=query, requester=ctx.author, loop=self.bot.loop)
+                tracks = Track.iter_playlist(playlist_url=query, requester=ctx.author, loop=self.bot.loop,
+                                             job=Job(ctx.guild.id, Priority.BULK))
             else:
-                tracks = [await Track.from_url(url=query, requester=ctx.author, loop=self.bot.loop)]
+                tracks = [await Track.from_url(url=query, requester=ctx.author, loop=self.bot.loop,
+                                               job=Job(ctx.guild.id))]
         else:
-            tracks = [await Track.from_search(query=query, requester=ctx.author, loop=self.bot.loop)]
+            tracks = [await Track.from_search(query=query, requester=ctx.author, loop=self.bot.loop,
+                                              job=Job(ctx.guild.id))]
+        if isinstance(tracks, list):
+            tracks[0].requested_at = requested_at  # include resolving the query in time to first audio
 
-        await player.add_to_queue(ctx, tracks)
+        await player.add_to_queue(ctx, tracks, download=None if stream is None else not stream)
 
     @commands.hybrid_command()
     async def spotify(
@@ -118,18 +150,20 @@ class Music(commands.Cog):
             limit: Numer of songs to add to the queue
         """
         player = await self.start_player(ctx)
+        if player is None:
+            return
 
         if category == 'link':
-            item, out_msg = self.spotify_handler.process_url(search)
+            item, out_msg = await self.spotify_handler.process_url(search)
         else:
-            item, out_msg = self.spotify_handler.process_search(search, category)
+            item, out_msg = await self.spotify_handler.process_search(search, category)
 
         if item is None:
             await response(ctx, out_msg)
             return
 
         category = item['type']
-        tracks = self.spotify_handler.get_tracks_from_spotify_object(
+        tracks = await self.spotify_handler.get_tracks_from_spotify_object(
             item, category, ctx, limit=limit, get_recommendations=False)
 
         await player.add_to_queue(ctx, tracks)
@@ -151,18 +185,20 @@ class Music(commands.Cog):
             limit: Numer of songs to add to the queue
         """
         player = await self.start_player(ctx)
+        if player is None:
+            return
 
         if category == 'link':
-            item, out_msg = self.spotify_handler.process_url(search)
+            item, out_msg = await self.spotify_handler.process_url(search)
         else:
-            item, out_msg = self.spotify_handler.process_search(search, category)
+            item, out_msg = await self.spotify_handler.process_search(search, category)
 
         if item is None:
             await response(ctx, out_msg)
             return
 
         category = item['type']
-        tracks = self.spotify_handler.get_tracks_from_spotify_object(
+        tracks = await self.spotify_handler.get_tracks_from_spotify_object(
             item, category, ctx, limit=limit, get_recommendations=True)
 
         await player.add_to_queue(ctx, tracks)
@@ -218,7 +254,7 @@ class Music(commands.Cog):
         if not vc or not vc.is_connected():
             await response(ctx, 'I am not currently playing anything!')
         else:
-            vc.stop()
+            self.get_player(ctx).skip()
             await response(ctx, f'**`{ctx.author}`**: Skipped the song')
 
     @commands.hybrid_command()
@@ -252,11 +288,13 @@ class Music(commands.Cog):
             ctx: discord Context object
         """
         player = self.get_player(ctx)
+        if player is None:
+            await response(ctx, 'I am not currently playing anything!')
+            return
         songs: List[Track] = []
         if player.current:
             songs.append(player.current)
-        if len(player.get_queue_items()) > 0:
-            songs.extend(player.get_queue_items())
+        songs.extend(player.get_queue_items())
 
         player = self.players.pop(ctx.guild.id, None)
         if player:
@@ -264,7 +302,8 @@ class Music(commands.Cog):
 
         if len(songs) > 0:
             player = await self.start_player(ctx)
-            await player.add_to_queue(ctx, songs)
+            if player is not None:
+                await player.add_to_queue(ctx, songs)
 
     @commands.hybrid_command(aliases=['q'])
     async def queue(
@@ -277,6 +316,9 @@ class Music(commands.Cog):
             ctx: discord Context object
         """
         player = self.get_player(ctx)
+        if player is None:
+            await response(ctx, 'I am not currently playing anything!')
+            return
         await response(ctx, 'Queue:')
         await player.send_new_embed_msg(ctx)
 
@@ -291,10 +333,66 @@ class Music(commands.Cog):
             ctx: discord Context object
         """
         player = self.get_player(ctx)
+        if player is None:
+            await response(ctx, 'I am not currently playing anything!')
+            return
         player.shuffle_queue()
         await response(ctx, f'**`{ctx.author}`**: Shuffled the queue')
         await player.send_new_embed_msg(ctx)
 
+    @commands.hybrid_command()
+    async def remove(
+        self,
+        ctx: commands.Context,
+        position: int
+    ):
+        """
+        Remove a song from the queue.
+        Args:
+            ctx: discord Context object
+            position: Position of the song in the queue
+        """
+        player = self.get_player(ctx)
+        if player is None:
+            await response(ctx, 'I am not currently playing anything!')
+            return
+        if not 0 <= position < player.queued:
+            await response(ctx, f'There is no song at position {position} in the queue.')
+            return
+        track = player.remove_from_queue(position)
+        if track is None:
+            await response(ctx, f'The song at position {position} is already starting.')
+            return
+        await response(ctx, f'**`{ctx.author}`**: Removed `{track.title}` from the queue')
+        await player.update_embed()
+
+    @commands.hybrid_command()
+    async def move(
+        self,
+        ctx: commands.Context,
+        position: int,
+        new_position: int
+    ):
+        """
+        Move a song to another position in the queue.
+        Args:
+            ctx: discord Context object
+            position: Current position of the song in the queue
+            new_position: New position of the song in the queue
+        """
+        player = self.get_player(ctx)
+        if player is None:
+            await response(ctx, 'I am not currently playing anything!')
+            return
+        if not 0 <= position < player.queued or not 0 <= new_position < player.queued:
+            await response(ctx, f'Positions must be between 0 and {player.queued - 1}.')
+            return
+        if not player.move_in_queue(position, new_position):
+            await response(ctx, 'The song at position 0 is already starting.')
+            return
+        await response(ctx, f'**`{ctx.author}`**: Moved song from position {position} to {new_position}')
+        await player.update_embed()
+
     @commands.hybrid_command()
     async def change_volume(
         self,
@@ -316,11 +414,56 @@ class Music(commands.Cog):
         else:
             player = self.get_player(ctx)
 
-            if vc.source:
+            msg = f'**`{ctx.author}`**: Set the volume to **{volume}%**'
+            if isinstance(vc.source, TrackMixer) and not vc.source.is_opus():
                 vc.source.volume = volume / 100
+            elif vc.source:
+                msg += ' (from the next song)'  # opus passthrough source
 
             player.volume = volume / 100
-            await response(ctx, f'**`{ctx.author}`**: Set the volume to **{volume}%**')
+            await response(ctx, msg)
+
+    @commands.hybrid_command()
+    async def crossfade(
+        self,
+        ctx: commands.Context,
+        seconds: float
+    ):
+        """
+        Crossfade between songs.
+        Args:
+            ctx: discord Context object
+            seconds: Length of the crossfade between 0 and 15, 0 for gapless playback
+        """
+        if not 0 <= seconds <= 15:
+            await response(ctx, 'Please enter a value between 0 and 15.')
+            return
+        self.settings.setdefault(ctx.guild.id, {})['crossfade'] = seconds
+        player = self.players.get(ctx.guild.id)
+        msg = f'**`{ctx.author}`**: Set crossfade to **{seconds}** seconds'
+        if player is not None:
+            player.set_crossfade(seconds)
+            if player.mixer is not None and player.mixer.is_opus() and not player.stopped.is_set():
+                msg += ' (from the next song)'  # opus passthrough can't be mixed, later songs are decoded
+        await response(ctx, msg)
+
+    @commands.hybrid_command()
+    async def streaming(
+        self,
+        ctx: commands.Context,
+        enabled: bool
+    ):
+        """
+        Stream songs instead of downloading them before playing.
+        Args:
+            ctx: discord Context object
+            enabled: Stream newly queued songs. Falls back to download if stream fails.
+        """
+        self.settings.setdefault(ctx.guild.id, {})['download'] = not enabled
+        player = self.players.get(ctx.guild.id)
+        if player is not None:
+            player.download = not enabled
+        await response(ctx, f'**`{ctx.author}`**: {"Enabled" if enabled else "Disabled"} streaming')
 
     @commands.hybrid_command()
     async def status(
@@ -340,6 +483,27 @@ class Music(commands.Cog):
         player = self.players[ctx.guild.id] if ctx.guild.id in self.players else None
         msg += f"Current player is {player}\n"
         if player:
-            msg += f"Current queue is {[item.title for item in player.get_queue_items()]}\n"
-
-        await response(ctx, msg)
+            msg += f"Current queue is {[item.title for item in player.queue[:10]]} ({len(player.queue)} songs)\n"
+            msg += f"Time to first audio: last {player.time_to_audio or 0:.2f} s, " \
+                   f"avg {player.avg_time_to_audio:.2f} s\n"
+        msg += f"Metadata cache: {metadata_cache.stats}\n"
+        msg += f"Search cache: {search_index.stats}, top queries {search_index.top(5)}\n"
+        msg += f"Audio cache: {audio_store.stats}\n"
+        msg += f"Extractor: {extractor.stats}\n"
+        msg += f"Resources of this process: {governor.summary}\n"
+        msg += f"YouTube throttling: {youtube_throttle.stats}\n"
+        msg += f"Deduplicated extractions: {extractions.stats}\n"
+        msg += f"Message edits: {edit_scheduler.stats}\n"
+        msg += f"Spotify cache: {self.spotify_handler.cache.stats}\n"
+        msg += f"Spotify to YouTube index: {youtube_index.stats}\n"
+        msg += f"Shard: {ctx.guild.shard_id}, this process: {self.stats}\n"
+        shards = load_shard_stats()
+        if shards:
+            totals = {key: value for key, value in shards.items() if key != 'per_process'}
+            msg += f"All shard processes: {totals}\n"
+
+        # more than fits into one message with all caches and shards
+        first, *rest = split_message(msg)
+        await response(ctx, first)
+        for chunk in rest:
+            await send(ctx, chunk)
@@ -0,0 +1,90 @@
+"""
+Audio pre-encoded into Opus packets, stored next to the downloaded audio file.
+Playing such file needs no FFmpeg process, packets are read from a memory mapped file.
+
+File format (native byte order): MAGIC, uint32 number of packets, uint32 (offset, length) for each packet,
+packet data.
+"""
+import os
+import mmap
+import array
+import struct
+import subprocess
+import discord
+from discord.oggparse import OggStream
+
+
+MAGIC = b'SLBOPUS1'
+HEADER = struct.Struct('=8sI')
+
+
+def frames_filename(audio_filename: str, volume: float) -> str:
+    """ Frames are encoded with fixed volume, so there is one file per used volume level. """
+    return f'{os.path.splitext(audio_filename)[0]}.v{round(volume * 100)}.opusframes'
+
+
+def convert(audio_filename: str, volume: float, copy: bool = False, bitrate: int = 128) -> str:
+    """
+    Encode audio file into Opus frames file. With copy, opus packets of the source are used as they are
+    (only possible with volume 1). Blocking, run it in executor.
+    """
+    filename = frames_filename(audio_filename, volume)
+    codec_args = ['-c:a', 'copy'] if copy else [
+        '-c:a', 'libopus', '-b:a', f'{bitrate}k', '-ar', '48000', '-ac', '2', '-filter:a', f'volume={volume}'
+    ]
+    args = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', audio_filename,
+            '-vn', '-map_metadata', '-1', '-f', 'opus', *codec_args, 'pipe:1']
+
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+        packets = [
+            packet for packet in OggStream(process.stdout).iter_packets()
+            if not packet.startswith((b'OpusHead', b'OpusTags'))
+        ]
+    if process.returncode != 0 or not packets:
+        raise RuntimeError(f'FFmpeg failed to encode {audio_filename} (exit code {process.returncode})')
+
+    index = array.array('I')
+    offset = HEADER.size + 2 * len(packets) * index.itemsize
+    for packet in packets:
+        index.extend((offset, len(packet)))
+        offset += len(packet)
+
+    tmp_filename = filename + '.part'
+    with open(tmp_filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(packets)))
+        index.tofile(f)
+        for packet in packets:
+            f.write(packet)
+    os.replace(tmp_filename, filename)
+    return filename
+
+
+class OpusFrameSource(discord.AudioSource):
+    """ Plays Opus frames file through mmap, without any child process. """
+
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f'{filename} is not an Opus frames file')
+        self._index = memoryview(self._mmap)[HEADER.size:HEADER.size + 8 * self.count].cast('I')
+        self.position = 0
+
+    def read(self) -> bytes:
+        if self.position >= self.count or self._index is None:
+            return b''
+        offset, length = self._index[2 * self.position], self._index[2 * self.position + 1]
+        self.position += 1
+        # slice of a few hundred bytes, voice encryption needs bytes anyway
+        return self._mmap[offset:offset + length]
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        if self._index is not None:
+            self._index.release()
+            self._index = None
+            self._mmap.close()
@@ -1,16 +1,23 @@
 """
 Source: https://gist.github.com/EvieePy/ab667b74e9758433b3eb806c53a19f34
 """
+import os
+import time
 import logging
 import asyncio
 from asyncio.timeouts import timeout
+from contextlib import aclosing
+from functools import partial
 import discord
 from discord.ext import commands
-from random import shuffle
-from typing import List
+from typing import AsyncIterator, Dict, List
 
 from music_player.track import Track, YTDLSource
+from music_player.governor import governor, Job, Priority
+from music_player.throttle import is_throttling
 from music_player.embed import PlayerEmbed
+from music_player.track_queue import TrackQueue
+from music_player.audio import TrackMixer, FRAMES_PER_SECOND
 from utils import response, edit
 
 
@@ -22,19 +29,51 @@ class MusicPlayer:
     When the bot disconnects from the Voice it's instance will be destroyed.
     """
 
-    def __init__(self, bot: commands.Bot, voice_client: discord.VoiceClient | None):
+    def __init__(
+            self,
+            bot: commands.Bot,
+            voice_client: discord.VoiceClient | None,
+            prefetch_limit: int = 3,
+            prefetch_concurrency: int = 2,
+            prefetch_max_bytes: int = 256 * 1024 * 1024,  # 256 MiB
+            queue_memory_limit: int = 500,
+    ):
         self.bot: commands.Bot = bot
         self.vc = voice_client
+        self.guild_id = voice_client.guild.id if voice_client is not None else None
         self.embed = PlayerEmbed()
 
-        self.queue = asyncio.Queue()
-        self.next = asyncio.Event()
+        self.queue = TrackQueue(memory_limit=queue_memory_limit)  # longer queues spill to disk
+        self.next = asyncio.Event()  # current song is about to end or stopped, next one is needed
+        self.stopped = asyncio.Event()  # voice client is not playing self.mixer
+        self.stopped.set()
+        self.mixer: TrackMixer | None = None  # plays songs one after another
+        self.crossfade = 0.  # seconds of crossfade between songs, 0 for gapless playback
 
         self.volume = .5
-        self.current = None
-        self.download = True
+        self.current: Track | None = None
+        self.download = True  # download songs before playing, or stream them
+        self.passthrough = True  # play opus audio without decoding and encoding it again
+
+        # look-ahead: resolve and download next songs in the queue while the current one plays
+        self.prefetch_limit = prefetch_limit  # number of upcoming songs to prepare
+        self.prefetch_max_bytes = prefetch_max_bytes  # disk budget for prepared songs of this guild
+        self.prefetch_semaphore = asyncio.Semaphore(prefetch_concurrency)
+        self.prepared: Dict[Track, YTDLSource] = {}  # sources of upcoming tracks, created by prefetch
+        self.queue_changed = asyncio.Event()
+
+        # background tasks adding songs to the queue
+        self.ingest_batch_size = 25
+        self.ingest_lock = asyncio.Lock()
+        self.ingest_tasks = set()
+
+        # seconds from request of a song to its first audio frame, if nothing was playing before
+        self.time_to_audio: float | None = None
+        self.avg_time_to_audio = 0.
+        self._idle_start: YTDLSource | None = None
 
         self.bot.loop.create_task(self.player_loop())
+        self.prefetch_task = self.bot.loop.create_task(self.prefetch_loop())
 
     async def player_loop(self):
         """Our main player loop."""
@@ -46,61 +85,216 @@ class MusicPlayer:
             try:
                 # Wait for the next song. If we timeout cancel the player and disconnect...
                 async with timeout(60):
-                    source: YTDLSource = await self.queue.get()
+                    track: Track = await self.queue.get()
             except asyncio.TimeoutError:
+                if not self.stopped.is_set():
+                    continue  # still playing a song of unknown duration
                 await self.destroy()
                 return
 
-            self.current = source
+            self.queue_changed.set()
+            source = self.prepared.pop(track, None) or YTDLSource(track, job=Job(self.guild_id))
+            # needed when the current song ends, also speeds up the prefetch if it still waits for resources
+            governor.promote(source.job, Priority.PLAYBACK, deadline=time.monotonic() + self.time_left())
 
             if self.vc is None:
                 continue
             else:
                 try:
-                    await source.get_yt_audiosource(self.bot.loop)
-                    source.audiosource.volume = self.volume
-                    self.vc.play(
-                        source.audiosource,
-                        after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set)
-                    )
+                    # crossfade mixes PCM, so it turns off passthrough
+                    passthrough = self.passthrough and self.crossfade == 0
+                    # already prepared by self.prefetch_loop() in most cases
+                    await source.get_yt_audiosource(self.bot.loop, self.volume, passthrough)
                 except Exception as e:
                     logging.warning(e)
+                    source.cleanup()
+                    if is_throttling(e):
+                        # keep the song, requests wait for the circuit breaker before it is tried again
+                        self.queue.insert(0, track)
+                        self.queue_changed.set()
                     continue
 
-            await self.update_embed()
+                # continue current mixer without a gap, or start a new one once the old one finished
+                if self.mixer is None or not self.mixer.set_next(source.audiosource, source, track.duration):
+                    await self.stopped.wait()
+                    self.mixer = TrackMixer(
+                        on_track_start=partial(self._threadsafe, self._on_track_start),
+                        on_track_end=partial(self._threadsafe, self._on_track_end),
+                        on_need_next=partial(self._threadsafe, lambda _: self.next.set()),
+                        crossfade=self.crossfade,
+                    )
+                    self.mixer.set_next(source.audiosource, source, track.duration)
+                    self._idle_start = source
+                    try:
+                        # set by the previous mixer when it stopped, the new one requests its next song itself
+                        self.next.clear()
+                        self.stopped.clear()
+                        self.vc.play(self.mixer, after=partial(self._threadsafe, self._on_mixer_stopped))
+                    except Exception as e:
+                        logging.warning(e)
+                        self.mixer.cleanup()
+                        self.stopped.set()
+                        continue
+
             await self.next.wait()
 
-            source.cleanup()
+    def time_left(self) -> float:
+        """ Seconds until the current song ends, 0 if nothing plays or its duration is unknown. """
+        if self.mixer is None or self.stopped.is_set():
+            return 0.
+        return self.mixer.remaining or 0.
+
+    def _threadsafe(self, callback, *args):
+        """ Schedule callback from audio thread on the event loop. """
+        self.bot.loop.call_soon_threadsafe(callback, *args)
+
+    def _on_track_start(self, source: YTDLSource):
+        self.current = source.track
+        if source is self._idle_start:
+            self._idle_start = None
+            self.time_to_audio = time.monotonic() - source.track.requested_at
+            self.avg_time_to_audio = self.time_to_audio if self.avg_time_to_audio == 0 \
+                else .9 * self.avg_time_to_audio + .1 * self.time_to_audio
+            logging.warning(f'First audio of {source.track.title} {self.time_to_audio:.2f}s after request')
+        self.bot.loop.create_task(self.update_embed())
 
+    def _on_track_end(self, source: YTDLSource):
+        source.cleanup()
+        if self.current is source.track:
             self.current = None
 
-    async def add_to_queue(self, ctx: commands.Context, tracks: List[Track]):
-        msg = await response(ctx, f'Processed 0/{len(tracks)} songs')
+    def _on_mixer_stopped(self, _error):
+        self.stopped.set()
+        self.next.set()
+        self.bot.loop.create_task(self.update_embed())
+
+    def skip(self):
+        """ Skip current song, next one starts immediately if it is already prepared. """
+        if self.mixer is not None and not self.stopped.is_set():
+            self.mixer.skip()
+        elif self.vc is not None:
+            self.vc.stop()
+
+    def set_crossfade(self, seconds: float):
+        self.crossfade = seconds
+        if self.mixer is not None:
+            self.mixer.crossfade_frames = int(seconds * FRAMES_PER_SECOND)
+
+    async def prefetch_loop(self):
+        """ Prepare next self.prefetch_limit songs in the queue in background. """
+        await self.bot.wait_until_ready()
+
+        while not self.bot.is_closed():
+            await self.queue_changed.wait()
+            self.queue_changed.clear()
+
+            upcoming: List[Track] = self.queue[:self.prefetch_limit]
+
+            # tracks which left the look-ahead window (removed, moved or shuffled) don't need their sources
+            for track in [track for track in self.prepared if track not in upcoming]:
+                self.prepared.pop(track).cleanup()
 
-        for i, track in enumerate(tracks):
+            prefetched_bytes = sum(
+                os.path.getsize(source.filename) for source in self.prepared.values()
+                if source.is_fetched and source.filename and os.path.isfile(source.filename)
+            )
+            # each song is needed when the songs before it have played
+            starts_at = time.monotonic() + self.time_left()
+            for track in upcoming:
+                deadline, starts_at = starts_at, starts_at + (track.duration or 0)
+                if track in self.prepared:
+                    continue
+                if prefetched_bytes >= self.prefetch_max_bytes:
+                    break
+                job = Job(self.guild_id, Priority.PREFETCH, deadline)
+                source = self.prepared[track] = YTDLSource(track, job=job)
+                task = source.prepare(self.bot.loop, self.prefetch_semaphore)
+                task.add_done_callback(partial(self._on_prefetched, track))
+
+    def _on_prefetched(self, track: Track, _task: asyncio.Task):
+        # resolving updates the duration, recalculate disk usage once the download is done
+        self.queue.refresh(track)
+        self.queue_changed.set()
+
+    async def add_to_queue(
+            self,
+            ctx: commands.Context,
+            tracks: List[Track] | AsyncIterator[List[Track]],
+            download: bool | None = None
+    ) -> asyncio.Task:
+        """
+        Add tracks to the queue in background. Tracks are added in batches, keeping their order
+        (also between multiple calls), with one embed and progress message update per batch.
+        Tracks can also be an async iterator of pages (e.g. of a playlist being read), then songs start
+        playing before all tracks are known.
+        """
+        total = f'/{len(tracks)}' if isinstance(tracks, list) else ''
+        msg = await response(ctx, f'Processed 0{total} songs')
+        download = self.download if download is None else download
+
+        task = self.bot.loop.create_task(self._ingest(msg, tracks, total, download))
+        self.ingest_tasks.add(task)
+        task.add_done_callback(self.ingest_tasks.discard)
+        return task
+
+    async def _batches(self, tracks: List[Track] | AsyncIterator[List[Track]]) -> AsyncIterator[List[Track]]:
+        if isinstance(tracks, list):
+            for start in range(0, len(tracks), self.ingest_batch_size):
+                yield tracks[start:start + self.ingest_batch_size]
+        else:
+            async with aclosing(tracks):
+                async for page in tracks:
+                    for start in range(0, len(page), self.ingest_batch_size):
+                        yield page[start:start + self.ingest_batch_size]
+
+    async def _ingest(
+            self, msg: discord.Message, tracks: List[Track] | AsyncIterator[List[Track]], total: str, download: bool
+    ):
+        async with self.ingest_lock:
+            failed = []
+            processed = 0
+            content = f'Processed 0{total} songs'
             try:
-                source = YTDLSource(track, download=self.download)
-                await self.queue.put(source)
-                await self.update_embed()
+                async with aclosing(self._batches(tracks)) as batches:
+                    async for batch in batches:
+                        for track in batch:
+                            try:
+                                track.check_availability()
+                            except ValueError as e:
+                                logging.warning(e)
+                                failed.append(track.url)
+                                continue
+                            track.download = download
+                            self.queue.put_nowait(track)
+                        self.queue_changed.set()
+                        processed += len(batch)
+
+                        await self.update_embed()
+                        content = f'Processed {processed}{total} songs'
+                        content += ''.join(f'\n- Could not add {url}' for url in failed)
+                        msg = await edit(msg, wait=False, content=content)
             except Exception as e:
-                logging.warning(e)
-                msg = await edit(
-                    msg, content=msg.content + f'\n- Could not add {track.url}'
-                )
-            msg = await edit(
-                msg, content=msg.content.replace(f'{i}/{len(tracks)}', f'{i+1}/{len(tracks)}')
-            )
+                # e.g. the playlist is private or could not be read further, report it instead of a stuck message
+                logging.warning(f'Could not add songs: {e}')
+                await edit(msg, wait=False, content=f'{content}\n- Could not read more songs: {e}')
+
+    def cancel_ingest(self):
+        """ Stop adding songs to the queue, e.g. stop reading a long playlist. """
+        for task in self.ingest_tasks:
+            task.cancel()
 
     async def destroy(self):
         """Disconnect and cleanup the player."""
         await self.update_embed()
 
-        # delete all downloaded audiofiles
-        queue = self.get_queue_items()
-        for source in queue:
+        self.prefetch_task.cancel()
+        self.cancel_ingest()
+
+        # release prepared audio files, they stay in the audio store until evicted
+        for source in self.prepared.values():
             source.cleanup()
-        # clear queue
-        self.queue = asyncio.Queue()
+        self.prepared.clear()
+        self.queue.clear()
 
         try:
             await self.vc.disconnect()
@@ -110,20 +304,71 @@ class MusicPlayer:
         if self.vc.guild.id in self.bot.cogs['Music'].players:
             self.bot.cogs['Music'].players.pop(self.vc.guild.id)
 
-    def get_queue_items(self):
-        # FIXME
-        return list(self.queue._queue)
+    @property
+    def pending(self) -> Track | None:
+        """ Next song, already handed to the mixer but not started yet. Shown as the first queued song. """
+        token = self.mixer.pending_token if self.mixer is not None else None
+        return token.track if token is not None else None
+
+    @property
+    def queued(self) -> int:
+        """ Number of songs after the current one, including the pending one. """
+        return len(self.queue) + (self.pending is not None)
+
+    def get_queue_items(self) -> List[Track]:
+        """ Songs to play after the current one, including the one already handed to the mixer. """
+        pending = self.pending
+        return ([pending] if pending is not None else []) + list(self.queue)
+
+    def _return_pending(self) -> bool:
+        """
+        Take the pending song back from the mixer to the head of the queue, so that queue positions match the
+        positions shown. Returns False if it can't be taken back because it is already fading in.
+        """
+        if self.pending is None:
+            return True
+        source: YTDLSource | None = self.mixer.take_pending()
+        if source is None:
+            return False
+        source.cleanup()
+        self.queue.insert(0, source.track)
+        self.next.set()  # player loop hands the head of the queue to the mixer again
+        return True
 
     def shuffle_queue(self):
-        # FIXME
-        shuffle(self.queue._queue)
+        self.queue.shuffle()
+        self.queue_changed.set()
+
+    def remove_from_queue(self, index: int) -> Track | None:
+        """ Remove song at position index of get_queue_items(). Returns None if the song has already started. """
+        if not self._return_pending():
+            if index == 0:
+                return None
+            index -= 1
+        track = self.queue.remove(index)
+        source = self.prepared.pop(track, None)
+        if source is not None:
+            source.cleanup()
+        self.queue_changed.set()
+        return track
+
+    def move_in_queue(self, src: int, dst: int) -> bool:
+        """ Move song between positions of get_queue_items(). Returns False if one of them has already started. """
+        if not self._return_pending():
+            if src == 0 or dst == 0:
+                return False
+            src, dst = src - 1, dst - 1
+        self.queue.move(src, dst)
+        self.queue_changed.set()
+        return True
 
     async def update_embed(self):
         curr_channel = self.vc.channel if hasattr(self.vc, 'channel') else None
         await self.embed.update(
             self.current,
-            self.get_queue_items(),
-            curr_channel
+            self.queue,
+            curr_channel,
+            self.pending,
         )
 
     async def send_new_embed_msg(self, ctx: commands.Context):
@@ -0,0 +1,51 @@
+import asyncio
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls with the same key: the first caller starts the call, callers arriving
+    before it finished await the same result (or exception). Cancelling a waiter cancels the call only if no
+    other caller waits for it anymore, e.g. when the only guild which wanted a prefetched song removed it.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._waiters: Counter[asyncio.Task] = Counter()
+        self.calls = 0
+        self.deduplicated = 0  # calls avoided by joining a call in flight
+        self.cancelled = 0  # calls cancelled because all their waiters were cancelled
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is not None:
+            self.deduplicated += 1
+        else:
+            self.calls += 1
+            task = asyncio.get_running_loop().create_task(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+            # exceptions are raised to the waiters, don't log them as never retrieved
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[task] == 1 and not task.done():
+                task.cancel()  # nobody else waits for the result
+                self.cancelled += 1
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if self._waiters[task] <= 0:
+                del self._waiters[task]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'in_flight': len(self._calls),
+            'calls': self.calls,
+            'deduplicated': self.deduplicated,
+            'cancelled': self.cancelled,
+        }
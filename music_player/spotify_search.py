@@ -1,23 +1,50 @@
 import os
+import asyncio
 import logging
-from typing import Optional, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional, Dict, List, Callable
 
 from spotipy.oauth2 import SpotifyClientCredentials
 import spotipy
 
+from music_player.cache import TTLCache
 from music_player.track import Track
 
 
+HOUR = 3600
+DAY = 24 * HOUR
+
+
 class SpotifyHandler:
-    def __init__(self):
+    """
+    Spotify API calls are blocking, so they run in a bounded executor and never on the event loop.
+    Responses are cached in memory and on disk.
+    """
+
+    def __init__(self, max_workers: int = 4):
         os.makedirs('cache', exist_ok=True)
         self.spotify = spotipy.Spotify(
             client_credentials_manager=SpotifyClientCredentials(
                 cache_handler=spotipy.cache_handler.CacheFileHandler(cache_path='cache/spotify.cache')
             )
         )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='spotify')
+        self.cache = TTLCache('cache/spotify.sqlite', ttl=DAY, max_entries=5000, memory_entries=500)
+
+    async def _call(self, key: str | None, ttl: float, func: Callable, *args, **kwargs):
+        """ Run spotipy function in executor, or get its result from cache. Pass key=None to skip cache. """
+        if key is not None:
+            result = self.cache.get(key)
+            if result is not None:
+                return result
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+        if key is not None:
+            self.cache.set(key, result, ttl=ttl)
+        return result
 
-    def process_search(self, search: str, category=None) -> (Dict | None, str):
+    async def process_search(self, search: str, category=None) -> (Dict | None, str):
         if category:
             categories = [category]
         else:
@@ -25,55 +52,65 @@ class SpotifyHandler:
 
         queried_items = []
         for category in categories:
-            results = self.spotify.search(search, type=category, limit=5)
+            results = await self._call(
+                f'search:{category}:{search.lower()}', DAY, self.spotify.search, search, type=category, limit=5
+            )
             queried_items = results[category + 's']['items']
             for item in queried_items:
                 if item['name'].lower() == search.lower():
-                    return item, f'Found {item['name']} in category {category}s.'
+                    return item, f'Found {item["name"]} in category {category}s.'
         out_msg = f'Could not find {search} in spotify.\n'
         if not category:
             out_msg += 'Try to specify search category by calling !play "<track|album|artist|playlist> {search}"'
         else:
-            out_msg += f'Maybe you meant one of {[item['name'] for item in queried_items]}?'
+            out_msg += f'Maybe you meant one of {[item["name"] for item in queried_items]}?'
         return None, out_msg
 
-    def process_url(self, url: str) -> (Dict | None, str):
+    async def process_url(self, url: str) -> (Dict | None, str):
+        url = url.split('?')[0]  # drop tracking parameters from cache key
         if 'track' in url:
-            item = self.spotify.track(url)
+            item = await self._call(f'track:{url}', 7 * DAY, self.spotify.track, url)
             out_msg = f'Found {item["name"]} in category tracks.'
         elif 'album' in url:
-            item = self.spotify.album(url)
+            item = await self._call(f'album:{url}', 7 * DAY, self.spotify.album, url)
             out_msg = f'Found {item["name"]} in category albums.'
         elif 'artist' in url:
-            item = self.spotify.artist(url)
+            item = await self._call(f'artist:{url}', DAY, self.spotify.artist, url)
             out_msg = f'Found {item["name"]} in category artists.'
         elif 'playlist' in url:
-            item = self.spotify.playlist(url)
+            item = await self._call(f'playlist:{url}', HOUR, self.spotify.playlist, url)
             out_msg = f'Found {item["name"]} in category playlists.'
         else:
-            item = None,
+            item = None
             out_msg = f'Unknown spotify url: {url}'
         return item, out_msg
 
-    def get_tracks_from_spotify_object(
+    async def get_tracks_from_spotify_object(
             self, item: Dict, category: str, ctx, get_recommendations=False, limit=None
     ) -> List[Track] | List[str]:
         if category == 'track':
             tracks = [item]
         elif category == 'artist':
-            tracks = self.spotify.artist_top_tracks(item['id'])['tracks']
+            top_tracks = await self._call(
+                f'artist_top_tracks:{item["id"]}', DAY, self.spotify.artist_top_tracks, item['id']
+            )
+            tracks = top_tracks['tracks']
         elif category == 'album':
-            tracks = self.spotify.album(item['id'])['tracks']['items']
+            album = await self._call(f'album:{item["id"]}', 7 * DAY, self.spotify.album, item['id'])
+            tracks = album['tracks']['items']
         elif category == 'playlist':
-            playlist_items = self.spotify.playlist_items(item['id'], limit=limit)['items']
-            tracks = [item['track'] for item in playlist_items]
+            playlist_items = await self._call(
+                f'playlist_items:{item["id"]}:{limit}', HOUR, self.spotify.playlist_items, item['id'], limit=limit
+            )
+            tracks = [item['track'] for item in playlist_items['items']]
         else:
             logging.warning(f'Unknown category: {category}. Category must be one of: track, artist, album, playlist.')
             return []
 
         if get_recommendations:
             rec_limit = min(len(tracks), 5)  # max 5 seed tracks
-            recommendations = self.spotify.recommendations(
+            recommendations = await self._call(
+                None, 0, self.spotify.recommendations,
                 seed_tracks=[track['id'] for track in tracks[:rec_limit]],
                 limit=limit
             )
@@ -85,8 +122,10 @@ class SpotifyHandler:
         tracks = self.extract_info_from_spotify_tracks(tracks, ctx)
         return tracks
 
-    def _get_artist_by_name(self, artist_name: str) -> Optional[Dict]:
-        searched_artists = self.spotify.search(artist_name, type='artist')['artists']['items']
+    async def _get_artist_by_name(self, artist_name: str) -> Optional[Dict]:
+        searched = await self._call(f'search:artist:{artist_name.lower()}:10', DAY, self.spotify.search,
+                                    artist_name, type='artist')
+        searched_artists = searched['artists']['items']
         searched_artists = sorted(searched_artists, key=lambda x: x['followers']['total'], reverse=True)
 
         artist = None
@@ -104,10 +143,12 @@ class SpotifyHandler:
             track = Track(
                 title=song['name'],
                 duration=int(song['duration_ms'] / 1000),
-                requester=ctx.author,
+                requester_id=ctx.author.id,
+                requester_name=ctx.author.display_name,
                 artist=song['artists'][0]['name'],
                 url=None,
                 thumbnail=None,
+                spotify_id=song['id'],
             )
             tracks.append(track)
         return tracks
@@ -0,0 +1,200 @@
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List
+
+from music_player.governor import governor, Job, Resource
+
+
+# parts of yt_dlp error messages when YouTube rate-limits us. Only the bot check of "Sign in to confirm ...",
+# "Sign in to confirm your age" is a permanent error of the video.
+THROTTLING_SIGNS = ('http error 429', 'too many requests', 'not a bot', 'rate-limit', 'rate limit')
+
+
+def is_throttling(error: BaseException) -> bool:
+    """ Whether the error means YouTube rejected the request because of its rate, not because of the video. """
+    message = str(error).lower()
+    return any(sign in message for sign in THROTTLING_SIGNS)
+
+
+class AdaptiveLimit:
+    """
+    Additive increase / multiplicative decrease of a governor resource limit. The limit grows by one after a
+    limit's worth of successful calls (about once per round of full concurrency), up to the configured limit,
+    and is cut by decrease on throttling. Throttled calls which started before the last cut don't cut it again.
+    """
+
+    def __init__(self, resource: Resource, min_limit: int = 1, decrease: float = .5, cooldown: float = 10):
+        self.resource = resource
+        self.max_limit = resource.limit
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._successes = 0
+        self._decreased_at = 0.
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.resource.limit and self.resource.limit < self.max_limit:
+            self._successes = 0
+            self.resource.set_limit(self.resource.limit + 1)
+
+    def on_throttled(self):
+        self._successes = 0
+        now = time.monotonic()
+        if now - self._decreased_at < self.cooldown:
+            return
+        self._decreased_at = now
+        self.resource.set_limit(max(int(self.resource.limit * self.decrease), self.min_limit))
+
+    @property
+    def stats(self) -> str:
+        return f'{self.resource.limit}/{self.max_limit}'
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests after threshold throttled calls in a row. While open, calls wait (instead of failing)
+    until reset_after passed, then one probe call is let through: if it isn't throttled the breaker closes,
+    otherwise it opens again for twice as long, up to max_reset_after.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30, max_reset_after: float = 600):
+        self.threshold = threshold
+        self.min_reset_after = reset_after
+        self.reset_after = reset_after
+        self.max_reset_after = max_reset_after
+
+        self.state = 'closed'  # 'closed', 'open' or 'half_open' (probe call running)
+        self.opened_at = 0.
+        self.failures = 0  # throttled calls in a row
+        self.trips = 0
+        self._changed = asyncio.Event()  # set and replaced on every change of state
+
+    def _set_state(self, state: str):
+        self.state = state
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self) -> bool:
+        """ Wait until a call may be sent. Returns True if the call is the probe, which must be reported. """
+        while True:
+            if self.state == 'closed':
+                return False
+            changed = self._changed
+            if self.state == 'open':
+                delay = self.opened_at + self.reset_after - time.monotonic()
+                if delay <= 0:
+                    self._set_state('half_open')
+                    return True
+                try:
+                    await asyncio.wait_for(changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await changed.wait()
+
+    def on_success(self, probe: bool):
+        self.failures = 0
+        if probe or self.state == 'half_open':
+            self.reset_after = self.min_reset_after
+            self._set_state('closed')
+
+    def on_throttled(self, probe: bool):
+        self.failures += 1
+        if probe:
+            self.reset_after = min(self.reset_after * 2, self.max_reset_after)
+            self._open()
+        elif self.state == 'closed' and self.failures >= self.threshold:
+            self._open()
+
+    def on_cancelled(self, probe: bool):
+        """ Probe didn't finish, let the next waiting call probe. """
+        if probe and self.state == 'half_open':
+            self.opened_at = time.monotonic() - self.reset_after
+            self._set_state('open')
+
+    def _open(self):
+        self.trips += 1
+        self.opened_at = time.monotonic()
+        self._set_state('open')
+        logging.warning(f'YouTube is throttling requests, pausing them for {self.reset_after:.0f}s')
+
+
+class YouTubeThrottle:
+    """
+    Runs YouTube requests in governor slots of adaptive size, retries throttled ones with jittered exponential
+    backoff and pauses all of them with a circuit breaker while YouTube keeps rejecting them. Under throttling
+    fewer requests run at once instead of all of them failing.
+    """
+
+    def __init__(
+            self,
+            resources: List[str],
+            retries: int = 4,
+            backoff: float = 2.,
+            max_backoff: float = 60.,
+    ):
+        self.limits = {name: AdaptiveLimit(governor.resources[name]) for name in resources}
+        self.breaker = CircuitBreaker()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.throttled = 0
+        self.retried = 0
+
+    async def call(self, resource: str, job: Job | None, func: Callable[[], Awaitable[Any]], retries: int = None):
+        """ Await func() in a slot of resource, retrying it if it is throttled. """
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            probe = await self.breaker.wait()
+            try:
+                async with governor.slot(resource, job):
+                    result = await func()
+            except asyncio.CancelledError:
+                self.breaker.on_cancelled(probe)
+                raise
+            except Exception as e:
+                if not is_throttling(e):
+                    self._on_success(resource, probe)  # YouTube answered, the request itself failed
+                    raise
+                self._on_throttled(resource, probe)
+                if attempt >= retries:
+                    raise
+                await self.wait_backoff(attempt, e)
+                attempt += 1
+            else:
+                self._on_success(resource, probe)
+                return result
+
+    async def wait_backoff(self, attempt: int, error: BaseException):
+        """ Sleep before retry number attempt, with full jitter so that retries of many calls spread out. """
+        self.retried += 1
+        delay = random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+        logging.warning(f'Retrying throttled YouTube request in {delay:.1f}s: {error}')
+        await asyncio.sleep(delay)
+
+    def _on_success(self, resource: str, probe: bool):
+        self.limits[resource].on_success()
+        self.breaker.on_success(probe)
+
+    def _on_throttled(self, resource: str, probe: bool):
+        self.throttled += 1
+        self.limits[resource].on_throttled()
+        self.breaker.on_throttled(probe)
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            'limits': {name: limit.stats for name, limit in self.limits.items()},
+            'breaker': self.breaker.state,
+            'trips': self.breaker.trips,
+            'throttled': self.throttled,
+            'retried': self.retried,
+        }
+
+
+youtube_throttle = YouTubeThrottle(['extract', 'download'])
@@ -1,47 +1,160 @@
 import os
+import re
+import time
+import unicodedata
 import asyncio
 import logging
+from asyncio.timeouts import timeout
+from contextlib import aclosing
 from functools import partial
-from typing import Dict
+from typing import AsyncIterator, Dict, IO, List, Set
 import discord
 from yt_dlp import YoutubeDL
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
+from music_player.cache import TTLCache
+from music_player.audio_store import AudioStore
+from music_player.extractor import ExtractorPool, ytdlopts
+from music_player.media_worker import MediaWorkerClient
+from music_player.singleflight import SingleFlight
+from music_player.governor import governor, Job, Priority, Slot
+from music_player.throttle import youtube_throttle, is_throttling
+from music_player.audio import PCMProcessor
+from music_player import opus_frames
+from music_player.opus_frames import OpusFrameSource
 
-ytdlopts = {
-    'format': 'bestaudio/best',
-    'outtmpl': 'cache/ytdl/%(extractor)s-%(id)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': True,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'auto',
-    'source_address': '0.0.0.0'  # ipv6 addresses cause issues sometimes
-}
 
-ytdl = YoutubeDL(ytdlopts)
+ytdl = YoutubeDL(ytdlopts)  # only for local helpers like prepare_filename(), extraction runs in extractor
 
+# yt_dlp jobs run in dedicated workers with their own YoutubeDL instances, or in the media worker daemon.
+# The pool has a worker for every governor slot, so admitted jobs never queue behind each other in the pool
+# and the governor alone decides which job runs next.
+if os.getenv('MEDIA_WORKER_SOCKET'):
+    extractor = MediaWorkerClient(os.getenv('MEDIA_WORKER_SOCKET'))
+else:
+    extractor = ExtractorPool(
+        ytdlopts,
+        max_workers=governor.resources['extract'].limit + governor.resources['download'].limit,
+        processes=False,
+    )
 
-@dataclass
+# concurrent extractions and downloads of the same video, and the jobs whose slots they wait for
+extractions = SingleFlight()
+_flight_jobs: Dict[str, Job] = {}
+
+# yt_dlp metadata cache. Processed info contains signed media urls, which expire after a few hours.
+metadata_cache = TTLCache('cache/metadata.sqlite', ttl=7 * 24 * 3600, max_entries=20000)
+PROCESSED_INFO_TTL = 3600
+
+# spotify track id -> resolved youtube video, skips text search for spotify tracks
+youtube_index = TTLCache('cache/spotify_youtube.sqlite', ttl=30 * 24 * 3600, max_entries=200000)
+
+# normalized search query -> resolved youtube video. Search results change slowly, entries older than
+# QUERY_STALENESS are searched again.
+QUERY_STALENESS = 3 * 24 * 3600
+search_index = TTLCache('cache/search.sqlite', ttl=QUERY_STALENESS, max_entries=50000, memory_entries=1000)
+
+# downloaded audio files shared by all guilds
+audio_store = AudioStore('cache/ytdl', max_bytes=4 * 1024 * 1024 * 1024)  # 4 GiB
+
+# background encoding of downloaded audio into Opus frames files, limited by governor 'encode' resource
+_converting: Set[str] = set()  # frames filenames being encoded
+
+YT_VIDEO_ID = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/)|youtu\.be/)([\w-]{11})')
+PUNCTUATION = re.compile(r'[^\w\s]|_')
+
+
+def cache_key(url: str) -> str:
+    """ Normalize url (or search query) so that different links to the same video share one cache entry. """
+    url = url.strip()
+    if match := YT_VIDEO_ID.search(url):
+        return f'youtube:{match.group(1)}'
+    return url
+
+
+def normalize_query(query: str) -> str:
+    """ Ignore case, punctuation and whitespace of search query, e.g. 'ABBA - Waterloo!' -> 'abba waterloo'. """
+    query = unicodedata.normalize('NFKC', query).casefold()
+    return ' '.join(PUNCTUATION.sub(' ', query).split())
+
+
+async def cached_extract_info(
+        url: str, download: bool = False, process: bool = True, job: Job | None = None
+) -> Dict:
+    """
+    yt_dlp extract_info() in extractor pool, which uses metadata_cache.
+    Concurrent calls for the same video (e.g. from different guilds) share one extraction and download.
+    Requests to YouTube wait for a governor slot of job. Shared calls use the first caller's job, raised to
+    the priority of more urgent callers joining it, so a song about to play doesn't wait with bulk priority.
+    """
+    key = f'{cache_key(url)}|{"processed" if process else "raw"}'
+    flight_key = f'{key}|{"download" if download else "info"}'
+    shared = _flight_jobs.get(flight_key)
+    if shared is not None and job is not None:
+        governor.promote(shared, job.priority, job.deadline)
+    return await extractions.do(
+        flight_key, partial(_cached_extract_info, flight_key, key, url, download, process, job or Job())
+    )
+
+
+async def _cached_extract_info(flight_key: str, key: str, url: str, download: bool, process: bool, job: Job) -> Dict:
+    _flight_jobs[flight_key] = job
+    try:
+        return await _extract_or_download(key, url, download, process, job)
+    finally:
+        _flight_jobs.pop(flight_key, None)
+
+
+async def _extract_or_download(key: str, url: str, download: bool, process: bool, job: Job) -> Dict:
+    data = metadata_cache.get(key)
+
+    if data is not None:
+        if not download or os.path.isfile(ytdl.prepare_filename(data)):
+            return data
+        try:
+            # download with cached format urls, skipping metadata requests
+            return await youtube_throttle.call('download', job, partial(extractor.download_from_info, data))
+        except Exception as e:
+            if is_throttling(e):
+                raise  # extracting again wouldn't help
+            logging.warning(f'Could not download {url} from cached info, extracting again: {e}')
+            metadata_cache.delete(key)
+
+    data = await youtube_throttle.call(
+        'download' if download else 'extract', job, partial(extractor.extract_info, url, download, process)
+    )
+    # flat search results change over time, keep them only as long as media urls
+    metadata_cache.set(key, data, ttl=PROCESSED_INFO_TTL if process or 'entries' in data else None)
+    return data
+
+
+@dataclass(slots=True, eq=False)
 class Track:
+    """
+    Compact record of a queued song. Long queues hold thousands of them, so it keeps only plain values
+    (requester id and name instead of the member object). Playback state lives in YTDLSource.
+    """
     title: str
-    duration: int
-    requester: discord.abc.User
+    duration: int | None
+    requester_id: int
+    requester_name: str
     artist: str | None = None
     url: str | None = None
     thumbnail: str | None = None
+    spotify_id: str | None = None
+    download: bool = True  # download before playing, or stream
+    requested_at: float = field(default_factory=time.monotonic)  # for time to first audio
 
     @classmethod
-    async def from_url(cls, url: str, requester: discord.abc.User, loop: asyncio.AbstractEventLoop):
-        to_run = partial(ytdl.extract_info, url=url, download=False, process=False)
-        data = await loop.run_in_executor(None, to_run)
+    async def from_url(
+            cls, url: str, requester: discord.abc.User, loop: asyncio.AbstractEventLoop, job: Job | None = None
+    ):
+        data = await cached_extract_info(url=url, download=False, process=False, job=job)
         track = cls(
             title=data['title'],
             duration=data['duration'],
-            requester=requester,
+            requester_id=requester.id,
+            requester_name=requester.display_name,
             artist=data['artist'] if 'artist' in data else None,
             url=data['webpage_url'],
             thumbnail=data['thumbnails'][0]['url'] if 'thumbnails' in data else None,
@@ -49,49 +162,121 @@ class Track:
         return track
 
     @classmethod
-    async def from_playlist(cls, playlist_url: str, requester: discord.abc.User, loop: asyncio.AbstractEventLoop):
+    async def iter_playlist(
+            cls,
+            playlist_url: str,
+            requester: discord.abc.User,
+            loop: asyncio.AbstractEventLoop,
+            page_size: int = 50,
+            job: Job | None = None,
+    ) -> AsyncIterator[List['Track']]:
+        """
+        Yield tracks of the playlist page by page, while the rest of the playlist is still being read.
+        If YouTube throttles reading the playlist, it is read again after a backoff, skipping entries already yielded.
+        """
         assert "playlist?list=" in playlist_url
-        to_run = partial(ytdl.extract_info, url=playlist_url, download=False, process=False)
-        data = await loop.run_in_executor(None, to_run)
-        tracks = []
-        for entry in data['entries']:
-            track = cls(
-                title=entry['title'],
-                duration=entry['duration'],
-                requester=requester,
-                artist=entry['artist'] if 'artist' in entry else None,
-                url=entry['url'],
-                thumbnail=entry['thumbnails'][0]['url'] if 'thumbnails' in entry else None,
-            )
-            tracks.append(track)
-        return tracks
+        job = job or Job(priority=Priority.BULK)
+        read = 0  # entries yielded so far
+        attempt = 0  # retries without progress
+        while True:
+            skip = read
+            try:
+                async with aclosing(extractor.iter_playlist(playlist_url, page_size)) as pages:
+                    while True:
+                        entries = await youtube_throttle.call('extract', job, partial(anext, pages, None), retries=0)
+                        if entries is None:
+                            return
+                        entries, skip = entries[skip:], max(skip - len(entries), 0)
+                        if entries:
+                            read += len(entries)
+                            attempt = 0
+                            yield [cls.from_playlist_entry(entry, requester) for entry in entries]
+            except Exception as e:
+                if not is_throttling(e) or attempt >= youtube_throttle.retries:
+                    raise
+                await youtube_throttle.wait_backoff(attempt, e)
+                attempt += 1
 
     @classmethod
-    async def from_search(cls, query: str, requester: discord.abc.User, loop: asyncio.AbstractEventLoop):
-        query = query.replace(':', '')
-        to_run = partial(ytdl.extract_info, url=query, download=False, process=False)
-        data = await loop.run_in_executor(None, to_run)
-        if 'entries' in data:
-            data = data['entries'][0]  # text search gives playlist with one entry out
-        track = cls(
-            title=data['title'] if 'title' in data else data['url'],
-            duration=data['duration'] if 'title' in data else None,
-            requester=requester,
-            artist=data['artist'] if 'artist' in data else None,
-            url=None,
+    def from_playlist_entry(cls, entry: Dict, requester: discord.abc.User):
+        return cls(
+            title=entry['title'],
+            duration=entry['duration'],
+            requester_id=requester.id,
+            requester_name=requester.display_name,
+            artist=entry['artist'] if 'artist' in entry else None,
+            url=entry['url'],
+            thumbnail=entry['thumbnails'][0]['url'] if 'thumbnails' in entry else None,
         )
-        return track
 
-    async def process(self, download: bool, loop: asyncio.AbstractEventLoop):
+    @classmethod
+    async def from_search(
+            cls, query: str, requester: discord.abc.User, loop: asyncio.AbstractEventLoop, job: Job | None = None
+    ):
+        """
+        Resolve text query to a video with one flat YouTube search. The track keeps the video url, so
+        processing it later only extracts formats of that video instead of searching again.
+        Resolved queries are kept in search_index, so repeated searches (also with different case or
+        punctuation) don't reach YouTube.
+        """
+        key = normalize_query(query)
+        entry = search_index.get(key) if key else None
+        if entry is None:
+            data = await cached_extract_info(
+                url=f'ytsearch1:{query.strip()}', download=False, process=False, job=job
+            )
+            if not data.get('entries'):
+                raise ValueError(f'No results for {query}')
+            result = data['entries'][0]
+            entry = {
+                'id': result['id'],
+                'url': result['url'],
+                'title': result['title'],
+                'duration': result.get('duration'),
+            }
+            if result.get('thumbnails'):
+                entry['thumbnails'] = result['thumbnails'][:1]
+            if key:
+                search_index.set(key, entry)
+        return cls.from_playlist_entry(entry, requester)
+
+    def check_availability(self):
+        if self.title == "[Private video]":
+            raise ValueError(f'Could not add private video {self.url}')
+        elif self.title == "[Deleted video]":
+            raise ValueError(f'Could not add deleted video {self.url}')
+
+    async def process(self, download: bool, loop: asyncio.AbstractEventLoop, job: Job | None = None):
         # process track
-        if self.url is None:
+        indexed = False
+        if self.url is None and self.spotify_id is not None:
+            resolved = youtube_index.get(self.spotify_id)
+            if resolved is not None:
+                self.url = resolved['url']
+                indexed = True
+        searched = self.url is None
+        if searched:
             self.url = f'{self.title} by {self.artist}' if self.artist else self.title
-        to_run = partial(ytdl.extract_info, url=self.url, download=download, process=True)
-        data = await loop.run_in_executor(None, to_run)
+        expected_duration = self.duration
+        try:
+            data = await cached_extract_info(url=self.url, download=download, process=True, job=job)
+        except Exception as e:
+            if not indexed or is_throttling(e):
+                raise
+            # indexed video was removed or became unavailable, search for the song again
+            logging.warning(f'Could not extract indexed video {self.url} of {self.title}, searching again: {e}')
+            youtube_index.delete(self.spotify_id)
+            self.url = None
+            return await self.process(download, loop, job)
 
         if 'entries' in data:
             data = data['entries'][0]
 
+        # remember search result for spotify track, if it is the same song
+        if searched and self.spotify_id is not None and 'webpage_url' in data \
+                and self.durations_match(expected_duration, data.get('duration')):
+            youtube_index.set(self.spotify_id, {'url': data['webpage_url'], 'duration': data['duration']})
+
         # update track info
         if 'title' in data:
             self.title = data['title']
@@ -106,46 +291,176 @@ class Track:
 
         return data
 
+    @staticmethod
+    def durations_match(expected: int | None, actual: int | None) -> bool:
+        if not expected or not actual:
+            return False
+        return abs(expected - actual) <= max(5, expected * .1)
 
-class YTDLSource(Track):
-    def __init__(self, track: Track, download=True):
-        super().__init__(track.title, track.duration, track.requester, track.artist, track.url)
 
-        # YTDL properties
-        self.download = download
-        self.ffmpegopts = {
-            'before_options': '-nostdin',
-            'options': '-vn'
-        }
-        self.filename: str | None = None
-        self.audiosource: discord.PCMVolumeTransformer | Dict | None = None
+def ffmpeg_stdout(source: discord.AudioSource) -> IO[bytes]:
+    """
+    Output pipe of the FFmpeg process behind source (or behind the PCMProcessor wrapping it).
+    discord.py keeps it private, but peeking into it is the only way to see whether FFmpeg produces audio
+    before the source is handed to the voice client, whose reads would consume the first frames.
+    """
+    ffmpeg_source = getattr(source, 'original', source)
+    return ffmpeg_source._stdout
 
-        self._check_availability()
 
-    def _check_availability(self):
-        # check track availability
-        if self.title == "[Private video]":
-            raise ValueError(f'Could not add private video {self.url}')
-        elif self.title == "[Deleted video]":
-            raise ValueError(f'Could not add deleted video {self.url}')
+class YTDLSource:
+    """
+    Playback state of a track: resolved info, downloaded file and opened AudioSource.
+    Created only for the song being played and the few songs being prefetched, not for the whole queue.
+    """
+    ffmpegopts = {
+        'before_options': '-nostdin',
+        'options': '-vn'
+    }
+    stream_ffmpegopts = {
+        'before_options': '-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+        'options': '-vn'
+    }
 
-    async def get_yt_audiosource(self, loop: asyncio.AbstractEventLoop):
-        loop = loop or asyncio.get_event_loop()
+    def __init__(self, track: Track, download: bool | None = None, job: Job | None = None):
+        self.track = track  # resolving updates the queued record in place
+        self.download = track.download if download is None else download
+        self.job = job or Job()  # guild and priority for governor resources
+        self.ffmpeg_slot: Slot | None = None  # held while an FFmpeg process plays this track
+        self.filename: str | None = None  # path to downloaded audio, acquired from audio_store
+        self.data: Dict | None = None  # processed yt_dlp info
+        self.audiosource: PCMProcessor | discord.FFmpegOpusAudio | OpusFrameSource | None = None
+        self.gain_db = 0.  # per-track gain on PCM path
+        self.fetch_task: asyncio.Task | None = None  # running or finished self.fetch()
+
+    async def fetch(self, loop: asyncio.AbstractEventLoop):
+        """ Resolve the track and download the audio file (if self.download) without opening it. """
+        self.data = await self.track.process(self.download, loop, self.job)
+        if self.download:
+            self.filename = ytdl.prepare_filename(self.data)
+            audio_store.acquire(self.filename)
+            audio_store.schedule_eviction(loop)
 
-        data = await self.process(self.download, loop)
+    def prepare(self, loop: asyncio.AbstractEventLoop, semaphore: asyncio.Semaphore | None = None) -> asyncio.Task:
+        """ Start self.fetch() in background, or return the already started task. """
+        if self.fetch_task is None:
+            self.fetch_task = loop.create_task(self._fetch_with(loop, semaphore))
+            # exceptions are raised to whoever awaits the task, don't log them as never retrieved
+            self.fetch_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return self.fetch_task
+
+    async def _fetch_with(self, loop: asyncio.AbstractEventLoop, semaphore: asyncio.Semaphore | None):
+        if semaphore is None:
+            return await self.fetch(loop)
+        async with semaphore:
+            return await self.fetch(loop)
+
+    @property
+    def is_fetched(self) -> bool:
+        return self.fetch_task is not None and self.fetch_task.done() and not self.fetch_task.cancelled() \
+            and self.fetch_task.exception() is None
+
+    @property
+    def is_opus(self) -> bool:
+        return self.data is not None and self.data.get('acodec') == 'opus'
+
+    def open_audiosource(self, volume: float = 1., passthrough: bool = False):
+        """
+        Create playable AudioSource from fetched data.
+        With passthrough, Opus audio is sent to discord without PCM processing in Python. Only at volume 1 the
+        Opus packets are copied as they are, other volumes are applied by FFmpeg, which decodes and encodes again,
+        and can not be changed during playback. If the song was played before with the same volume, its
+        pre-encoded Opus frames are played without FFmpeg.
+        """
+        if passthrough and self.download:
+            frames_filename = opus_frames.frames_filename(self.filename, volume)
+            if os.path.isfile(frames_filename):
+                try:
+                    self.audiosource = OpusFrameSource(frames_filename)
+                    return
+                except (OSError, ValueError) as e:
+                    logging.warning(f'Could not open {frames_filename}: {e}')
 
         if self.download:
-            self.filename = ytdl.prepare_filename(data)
-            audiosource = discord.FFmpegPCMAudio(self.filename, **self.ffmpegopts)
-            self.audiosource = discord.PCMVolumeTransformer(audiosource)  # AudioSource with volume control
+            source, ffmpegopts = self.filename, self.ffmpegopts
         else:
-            self.audiosource = data
+            source, ffmpegopts = self.data['url'], self.stream_ffmpegopts
+
+        if passthrough and self.is_opus:
+            if volume == 1:
+                # copy opus packets as they are
+                self.audiosource = discord.FFmpegOpusAudio(source, codec='opus', **ffmpegopts)
+            else:
+                self.audiosource = discord.FFmpegOpusAudio(
+                    source, before_options=ffmpegopts['before_options'],
+                    options=f'{ffmpegopts["options"]} -filter:a volume={volume}'
+                )
+        else:
+            audiosource = discord.FFmpegPCMAudio(source, **ffmpegopts)
+            self.audiosource = PCMProcessor(audiosource, volume, self.gain_db)  # AudioSource with volume control
+
+    async def get_yt_audiosource(self, loop: asyncio.AbstractEventLoop, volume: float = 1., passthrough: bool = False):
+        loop = loop or asyncio.get_event_loop()
+
+        await self.prepare(loop)
+        if self.ffmpeg_slot is None:
+            self.ffmpeg_slot = await governor.acquire('ffmpeg', self.job)
+        self.open_audiosource(volume, passthrough)
+        if isinstance(self.audiosource, OpusFrameSource):
+            self.ffmpeg_slot.release()  # pre-encoded frames don't need FFmpeg
+            self.ffmpeg_slot = None
+
+        if not self.download and not await self._stream_started(loop):
+            logging.warning(f'Could not stream {self.track.url}, falling back to download')
+            self.audiosource.cleanup()
+            self.download = True
+            self.fetch_task = None
+            await self.prepare(loop)
+            self.open_audiosource(volume, passthrough)
+
+        if passthrough and self.download and not isinstance(self.audiosource, OpusFrameSource):
+            frames_filename = opus_frames.frames_filename(self.filename, volume)
+            if frames_filename not in _converting:
+                _converting.add(frames_filename)
+                # the task holds its own reference, the song may be skipped and cleaned up before it finishes
+                audio_store.acquire(self.filename)
+                loop.create_task(self.convert_frames(self.filename, frames_filename, volume))
+
+    async def convert_frames(self, filename: str, frames_filename: str, volume: float):
+        """ Encode Opus frames file for next plays of this song with the same volume. """
+        try:
+            async with governor.slot('encode', Job(self.job.guild_id, Priority.BULK)):
+                copy = self.is_opus and volume == 1
+                await extractor.convert_frames(filename, volume, copy)
+            audio_store.refresh(filename)
+        except Exception as e:
+            logging.warning(f'Failed to encode Opus frames of {filename}: {e}')
+        finally:
+            _converting.discard(frames_filename)
+            audio_store.release(filename)
+
+    async def _stream_started(self, loop: asyncio.AbstractEventLoop, wait: float = 15) -> bool:
+        """
+        Wait until FFmpeg outputs first bytes of the stream, without consuming them.
+        Only a stream which doesn't start falls back to download. Interruptions later in the song are left to
+        FFmpeg's reconnect options, if they fail the song ends early.
+        """
+        stdout = ffmpeg_stdout(self.audiosource)
+        try:
+            async with timeout(wait):
+                return len(await loop.run_in_executor(None, stdout.peek, 1)) > 0
+        except asyncio.TimeoutError:
+            return False
 
     def cleanup(self):
-        # Delete downloaded audio file
-        if isinstance(self.filename, str) and os.path.isfile(self.filename):
-            # source.source is path to downloaded audio
-            os.remove(self.filename)
+        # Stop background download, unless another song waits for the same video
+        if self.fetch_task is not None and not self.fetch_task.done():
+            self.fetch_task.cancel()
+
+        # Downloaded audio file stays in audio_store for replays, until it gets evicted
+        if self.filename is not None:
+            audio_store.release(self.filename)
+            self.filename = None
 
         # Make sure the FFmpeg process is cleaned up.
         if self.audiosource:
@@ -153,3 +468,6 @@ class YTDLSource(Track):
                 self.audiosource.cleanup()  # FIXME
             except Exception as e:
                 logging.warning(f'Failed to cleanup FFmpeg process: {e}')
+        if self.ffmpeg_slot is not None:
+            self.ffmpeg_slot.release()
+            self.ffmpeg_slot = None
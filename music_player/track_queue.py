@@ -0,0 +1,326 @@
+import os
+import json
+import asyncio
+import sqlite3
+import tempfile
+from collections import deque
+from dataclasses import asdict
+from itertools import islice
+from random import shuffle
+from typing import Deque, Dict, Iterator, List
+
+from music_player.track import Track
+
+
+class TrackSpill:
+    """
+    On-disk continuation of a queue, ordered by position. Used for tracks beyond the in-memory part of
+    very long queues. The SQLite file is temporary and is deleted by close().
+    """
+
+    def __init__(self, directory: str = 'cache/queues'):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite', dir=directory)
+        os.close(fd)
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=MEMORY')
+        self._db.execute('PRAGMA synchronous=OFF')  # nothing to recover after a crash
+        self._db.execute('CREATE TABLE spill (pos REAL PRIMARY KEY, track TEXT NOT NULL)')
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    @staticmethod
+    def _dump(track: Track) -> str:
+        return json.dumps(asdict(track))
+
+    @staticmethod
+    def _load(row) -> Track:
+        return Track(**json.loads(row[0]))
+
+    def _pos(self, index: int) -> float:
+        return self._db.execute('SELECT pos FROM spill ORDER BY pos LIMIT 1 OFFSET ?', (index,)).fetchone()[0]
+
+    def _bound(self, func: str) -> float:
+        return self._db.execute(f'SELECT {func}(pos) FROM spill').fetchone()[0] or 0
+
+    def extend(self, tracks: List[Track]):
+        start = self._bound('MAX') + 1
+        self._db.executemany(
+            'INSERT INTO spill (pos, track) VALUES (?, ?)',
+            ((start + i, self._dump(track)) for i, track in enumerate(tracks))
+        )
+        self._len += len(tracks)
+
+    def extendleft(self, tracks: List[Track]):
+        """ Insert tracks in front, keeping their order. """
+        start = self._bound('MIN') - len(tracks)
+        self._db.executemany(
+            'INSERT INTO spill (pos, track) VALUES (?, ?)',
+            ((start + i, self._dump(track)) for i, track in enumerate(tracks))
+        )
+        self._len += len(tracks)
+
+    def insert(self, index: int, track: Track):
+        if index <= 0:
+            return self.extendleft([track])
+        if index >= self._len:
+            return self.extend([track])
+        before, after = self._pos(index - 1), self._pos(index)
+        pos = (before + after) / 2
+        if not before < pos < after:  # ran out of float precision between the two
+            self._renumber('pos')
+            pos = index - .5  # between index - 1 and index
+        self._db.execute('INSERT INTO spill (pos, track) VALUES (?, ?)', (pos, self._dump(track)))
+        self._len += 1
+
+    def read(self, start: int, stop: int) -> List[Track]:
+        rows = self._db.execute(
+            'SELECT track FROM spill ORDER BY pos LIMIT ? OFFSET ?', (max(stop - start, 0), start)
+        ).fetchall()
+        return [self._load(row) for row in rows]
+
+    def pop(self, index: int) -> Track:
+        pos = self._pos(index)
+        track = self._load(self._db.execute('SELECT track FROM spill WHERE pos = ?', (pos,)).fetchone())
+        self._db.execute('DELETE FROM spill WHERE pos = ?', (pos,))
+        self._len -= 1
+        return track
+
+    def popleft(self, count: int) -> List[Track]:
+        rows = self._db.execute('SELECT pos, track FROM spill ORDER BY pos LIMIT ?', (count,)).fetchall()
+        if rows:
+            self._db.execute('DELETE FROM spill WHERE pos <= ?', (rows[-1][0],))
+            self._len -= len(rows)
+        return [self._load(row[1:]) for row in rows]
+
+    def __iter__(self) -> Iterator[Track]:
+        # in chunks, without loading the whole spill at once
+        last = None
+        while True:
+            rows = self._db.execute(
+                'SELECT pos, track FROM spill WHERE ? IS NULL OR pos > ? ORDER BY pos LIMIT 500', (last, last)
+            ).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield from (self._load(row[1:]) for row in rows)
+
+    def _renumber(self, order: str):
+        """ Set positions to 0, 1, 2, ... in the given order. """
+        self._db.execute(f'CREATE TEMP TABLE ordered AS SELECT track FROM spill ORDER BY {order}')
+        self._db.execute('DELETE FROM spill')
+        self._db.execute('INSERT INTO spill (pos, track) SELECT rowid - 1, track FROM ordered')
+        self._db.execute('DROP TABLE ordered')
+
+    def shuffle(self):
+        self._renumber('random()')
+
+    def close(self):
+        self._db.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class TrackQueue:
+    """
+    Async FIFO queue of tracks with indexed access, which keeps totals of queued duration up to date on every
+    change, so rendering queue info doesn't depend on the queue length.
+    Only the first memory_limit tracks are kept in memory, the rest of the queue spills to a TrackSpill on disk.
+    Tracks read from the spill are new objects, only tracks in memory keep their identity.
+    """
+
+    def __init__(self, memory_limit: int = 500):
+        self.memory_limit = max(memory_limit, 1)
+        self._items: Deque[Track] = deque()
+        self._spill: TrackSpill | None = None  # created when the queue gets longer than memory_limit
+        self._getters: Deque[asyncio.Future] = deque()
+        self._counted: Dict[int, int | None] = {}  # id(track) -> duration included in the totals, tracks in memory
+
+        self.queue_time = 0  # sum of known durations in seconds
+        self.unknown_duration = 0  # number of tracks without known duration
+        self.version = 0  # incremented on every change, e.g. to cache rendered pages
+
+    @property
+    def spilled(self) -> int:
+        """ Number of tracks stored on disk. """
+        return len(self._spill) if self._spill is not None else 0
+
+    def __len__(self) -> int:
+        return len(self._items) + self.spilled
+
+    def __iter__(self) -> Iterator[Track]:
+        yield from list(self._items)
+        if self._spill is not None:
+            yield from self._spill
+
+    def __getitem__(self, index: int | slice) -> Track | List[Track]:
+        in_memory = len(self._items)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            tracks = list(islice(self._items, start, stop))
+            if stop > in_memory and self.spilled:
+                tracks += self._spill.read(max(start - in_memory, 0), stop - in_memory)
+            return tracks
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('queue index out of range')
+        if index < in_memory:
+            return self._items[index]
+        return self._spill.read(index - in_memory, index - in_memory + 1)[0]
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def _add(self, duration: int | None):
+        if duration:
+            self.queue_time += duration
+        else:
+            self.unknown_duration += 1
+
+    def _sub(self, duration: int | None):
+        if duration:
+            self.queue_time -= duration
+        else:
+            self.unknown_duration -= 1
+
+    def _count(self, track: Track):
+        self._counted[id(track)] = track.duration
+        self._add(track.duration)
+
+    def _uncount(self, track: Track):
+        self._sub(self._counted.pop(id(track)))
+
+    def refresh(self, track: Track):
+        """ Update totals after duration of a queued track has changed. Does nothing if it is not queued. """
+        if id(track) in self._counted:
+            self._uncount(track)
+            self._count(track)
+            self.version += 1
+
+    def _spill_tail(self):
+        """ Move tracks beyond memory_limit to disk. """
+        excess = len(self._items) - self.memory_limit
+        if excess <= 0:
+            return
+        if self._spill is None:
+            self._spill = TrackSpill()
+        tail = [self._items.pop() for _ in range(excess)][::-1]
+        for track in tail:
+            self._uncount(track)
+            self._add(track.duration)  # spilled tracks stay in the totals with their current duration
+        self._spill.extendleft(tail)
+
+    def _refill(self):
+        """ Load tracks from disk once half of the in-memory part was consumed. """
+        if not self.spilled or len(self._items) > self.memory_limit // 2:
+            return
+        for track in self._spill.popleft(self.memory_limit - len(self._items)):
+            self._sub(track.duration)
+            self._items.append(track)
+            self._count(track)
+
+    def put_nowait(self, track: Track):
+        self.version += 1
+        if self.spilled or len(self._items) >= self.memory_limit:
+            if self._spill is None:
+                self._spill = TrackSpill()
+            self._spill.extend([track])
+            self._add(track.duration)
+        else:
+            self._items.append(track)
+            self._count(track)
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    async def put(self, track: Track):
+        self.put_nowait(track)
+
+    def get_nowait(self) -> Track:
+        if not self._items:
+            raise asyncio.QueueEmpty
+        track = self._items.popleft()
+        self._uncount(track)
+        self._refill()
+        self.version += 1
+        return track
+
+    async def get(self) -> Track:
+        while not self._items:
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                getter.cancel()
+                raise
+        return self.get_nowait()
+
+    def remove(self, index: int) -> Track:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('queue index out of range')
+        self.version += 1
+        if index >= len(self._items):
+            track = self._spill.pop(index - len(self._items))
+            self._sub(track.duration)
+            return track
+        track = self._items[index]
+        del self._items[index]
+        self._uncount(track)
+        self._refill()
+        return track
+
+    def insert(self, index: int, track: Track):
+        """ Insert track before index, out of range indexes insert at the start or end like list.insert(). """
+        if index < 0:
+            index += len(self)
+        index = min(max(index, 0), len(self))
+        self.version += 1
+        if index <= len(self._items) and (index < self.memory_limit or not self.spilled):
+            self._items.insert(index, track)
+            self._count(track)
+            self._spill_tail()
+        else:
+            self._spill.insert(index - len(self._items), track)
+            self._add(track.duration)
+
+    def move(self, src: int, dst: int):
+        self.insert(dst, self.remove(src))
+
+    def shuffle(self):
+        self.version += 1
+        if not self.spilled:
+            items = list(self._items)
+            shuffle(items)
+            self._items = deque(items)
+            return
+        # shuffle on disk, then load the new head of the queue
+        self._spill.extendleft(list(self._items))
+        for track in self._items:
+            self._uncount(track)
+            self._add(track.duration)
+        self._items.clear()
+        self._spill.shuffle()
+        self._refill()
+
+    def clear(self):
+        """ Remove all tracks from the queue. """
+        self.version += 1
+        self._items.clear()
+        self._counted.clear()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self.queue_time = 0
+        self.unknown_duration = 0
@@ -1,7 +1,14 @@
+import json
+import asyncio
+import logging
+from typing import Dict, List, Tuple
 import discord
 from discord.ext import commands
 
 
+SHARD_STATS_FILE = 'cache/shards.json'  # written by launcher.py
+
+
 async def response(ctx: discord.Interaction | commands.Context, *args, **kwargs):
     try:
         if isinstance(ctx, discord.Interaction):
@@ -14,14 +21,138 @@ async def response(ctx: discord.Interaction | commands.Context, *args, **kwargs)
         return await send(ctx, *args, **kwargs)
 
 
-async def edit(msg: discord.Message, *args, **kwargs):
+class EditScheduler:
+    """
+    Outbound queue for message edits. Only the latest pending edit of each message is kept (edits of different
+    fields are merged) and sent at most once per min_interval, so bursts of state changes don't hit Discord
+    rate limits. Edits of different messages don't wait for each other.
+    """
+
+    def __init__(self, min_interval: float = 1.0):
+        self.min_interval = min_interval
+
+        self.sent = 0
+        self.merged = 0  # edits replaced by a newer edit of the same message before being sent
+        self.failed = 0
+
+        self._pending: Dict[int, Tuple[discord.Message, Dict, List[asyncio.Future]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._replaced: Dict[int, discord.Message] = {}  # message id -> message sent instead of editing it
+
+    def current(self, msg: discord.Message) -> discord.Message:
+        """ Message which replaced msg, if editing it failed and the edit was sent as a new message. """
+        while msg.id in self._replaced:
+            msg = self._replaced[msg.id]
+        return msg
+
+    def submit(self, msg: discord.Message, wait: bool = True, **kwargs) -> asyncio.Future | None:
+        loop = asyncio.get_running_loop()
+        msg = self.current(msg)
+        future = loop.create_future() if wait else None
+
+        if msg.id in self._pending:
+            _, pending_kwargs, futures = self._pending[msg.id]
+            self.merged += 1
+            self._pending[msg.id] = (msg, {**pending_kwargs, **kwargs}, futures)
+        else:
+            futures = []
+            self._pending[msg.id] = (msg, kwargs, futures)
+        if future is not None:
+            futures.append(future)
+
+        if msg.id not in self._workers:
+            self._workers[msg.id] = loop.create_task(self._flush(msg.id))
+        return future
+
+    def discard(self, msg: discord.Message):
+        """ Drop pending edit of the message, e.g. because the message was edited as interaction response. """
+        msg = self.current(msg)
+        pending = self._pending.pop(msg.id, None)
+        if pending is not None:
+            for future in pending[2]:
+                if not future.done():
+                    future.set_result(msg)
+
+    async def _flush(self, msg_id: int):
+        loop = asyncio.get_running_loop()
+        try:
+            while msg_id in self._pending:
+                msg, kwargs, futures = self._pending.pop(msg_id)
+                started = loop.time()
+                try:
+                    result = await _edit(msg, **kwargs)
+                    self.sent += 1
+                    if result is not None and result.id != msg.id:
+                        self._replaced[msg.id] = result  # later edits go to the new message
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(result)
+                except Exception as e:
+                    self.failed += 1
+                    logging.warning(f'Failed to edit message {msg_id}: {e}')
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                # discord.py already waits out 429s inside msg.edit(), so only sleep for the rest of the interval
+                await asyncio.sleep(self.min_interval - (loop.time() - started))
+        finally:
+            self._workers.pop(msg_id, None)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': len(self._pending),
+            'sent': self.sent,
+            'merged': self.merged,
+            'failed': self.failed,
+        }
+
+
+edit_scheduler = EditScheduler()
+
+
+async def edit(msg: discord.Message, wait: bool = True, **kwargs):
+    """
+    Edit message through edit_scheduler. If wait is False, return immediately instead of waiting for the
+    (possibly merged) edit to be sent. Returns the edited message, or the message sent instead of it once
+    the edit fell back to a new message.
+    """
+    future = edit_scheduler.submit(msg, wait=wait, **kwargs)
+    if future is None:
+        return edit_scheduler.current(msg)
+    return await future
+
+
+async def _edit(msg: discord.Message, **kwargs):
     try:
         if 'allowed_mentions' not in kwargs:
             kwargs['allowed_mentions'] = discord.AllowedMentions.none()
-        return await msg.edit(*args, **kwargs)
+        return await msg.edit(**kwargs)
     except discord.HTTPException:  # Webhook Token expires after 900 seconds
-        return await msg.channel.send(*args, **kwargs)
+        return await msg.channel.send(**kwargs)
 
 
 async def send(ctx: discord.Interaction | commands.Context, *args, **kwargs):
     return await ctx.channel.send(*args, **kwargs)
+
+
+def split_message(text: str, limit: int = 2000) -> List[str]:
+    """ Split text at line ends into chunks which fit into one Discord message. """
+    chunks = ['']
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(chunks[-1]) + len(line) > limit:
+            chunks.append('')
+        chunks[-1] += line
+    return [chunk for chunk in chunks if chunk]
+
+
+def load_shard_stats() -> Dict | None:
+    """ Aggregated stats of all bot processes, if the bot was started by launcher.py. """
+    try:
+        with open(SHARD_STATS_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None